@@ -28,39 +28,874 @@
 # pylint: disable=wrong-import-position
 # pylint: disable=wrong-import-order
 import sys
+import os
 sys.path.append('/usr/local/lib/cloudi-2.0.7/api/python/')
 from cloudi import API, TerminateException
 import threading
 import traceback
+import mmap
 import json
 import struct
 import time
 import random
+import itertools
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import heapq
 from timeit import default_timer
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+class Configuration(object):
+    # class attribute settings may be provided in the service environment
+    # (e.g., ODROID_FISH_LAKESTATE_NODES_X=3 sets LakeState.nodes_x = 3)
+    prefix = 'ODROID_FISH_'
+
+    @staticmethod
+    def setup(classes):
+        for cls in classes:
+            for name, value in list(vars(cls).items()):
+                if name.startswith('_'):
+                    continue
+                setting = os.environ.get(
+                    Configuration.prefix + cls.__name__.upper() + '_' +
+                    name.upper()
+                )
+                if setting is None:
+                    continue
+                if isinstance(value, bool):
+                    value = setting.lower() in ('1', 'true', 'yes', 'on')
+                elif isinstance(value, (int, float, str)):
+                    value = type(value)(setting)
+                else:
+                    continue
+                setattr(cls, name, value)
+
+class Log(object):
+    # asynchronous stdout logging with a background writer thread
+    # (the CloudI service captures stdout)
+    level = 'info' # error, warn, info or debug
+    frames = False # log the ASCII art frames sent to each lake position?
+    queue_size = 4096 # pending log messages (more are dropped)
+    rate_max = 20 # log messages per second for each message type
+    rate_sample = 100 # above rate_max, log 1 of every rate_sample messages
+    levels = {
+        'error': 0,
+        'warn': 1,
+        'info': 2,
+        'debug': 3,
+    }
+    __queue = None
+    __lock = threading.Lock()
+    __dropped = 0
+    __rates = {} # message type -> [second, count, suppressed]
+
+    @staticmethod
+    def error(kind, message, *args):
+        Log.__log(0, kind, message, args)
+
+    @staticmethod
+    def warn(kind, message, *args):
+        if Log.levels[Log.level] >= 1:
+            Log.__log(1, kind, message, args)
+
+    @staticmethod
+    def info(kind, message, *args):
+        if Log.levels[Log.level] >= 2:
+            Log.__log(2, kind, message, args)
+
+    @staticmethod
+    def debug(kind, message, *args):
+        if Log.levels[Log.level] >= 3:
+            Log.__log(3, kind, message, args)
+
+    @staticmethod
+    def setup():
+        # check the settings at startup (e.g., from ODROID_FISH_LOG_LEVEL),
+        # using the nearest valid setting instead of an invalid setting
+        invalid = []
+        if Log.level not in Log.levels:
+            invalid.append('level=%s' % Log.level)
+            Log.level = 'info'
+        if Log.rate_max < 0:
+            invalid.append('rate_max=%d' % Log.rate_max)
+            Log.rate_max = 0
+        if Log.rate_sample < 1:
+            invalid.append('rate_sample=%d' % Log.rate_sample)
+            Log.rate_sample = 1
+        if invalid != []:
+            Log.error('log', 'invalid %s (using level=%s rate_max=%d '
+                      'rate_sample=%d)', ' '.join(invalid),
+                      Log.level, Log.rate_max, Log.rate_sample)
+
+    @staticmethod
+    def configure(request):
+        # change logging at runtime with a service request
+        # (e.g., b'level=debug frames=true'), with the settings
+        # (preceded by the invalid setting, if any, which changes nothing)
+        # as the response
+        settings = {}
+        invalid = '(not UTF-8)'
+        try:
+            for setting in request.decode('utf-8').split():
+                invalid = setting
+                (name, _, value) = setting.partition('=')
+                if name == 'level':
+                    if value not in Log.levels:
+                        break
+                    settings[name] = value
+                elif name == 'frames':
+                    settings[name] = value.lower() in ('1', 'true',
+                                                       'yes', 'on')
+                elif name == 'rate_max':
+                    settings[name] = int(value)
+                    if settings[name] < 0:
+                        break
+                elif name == 'rate_sample':
+                    settings[name] = int(value)
+                    if settings[name] < 1:
+                        break
+                else:
+                    break
+            else:
+                invalid = None
+        except (UnicodeDecodeError, ValueError):
+            pass
+        if invalid is None:
+            for name, value in settings.items():
+                setattr(Log, name, value)
+            prefix = ''
+        else:
+            prefix = 'invalid=%s ' % invalid
+        return (prefix + 'level=%s frames=%s rate_max=%d rate_sample=%d' % (
+            Log.level, str(Log.frames).lower(),
+            Log.rate_max, Log.rate_sample,
+        )).encode('utf-8')
+
+    @staticmethod
+    def __log(level, kind, message, args):
+        # rate limit each message type
+        # (counts are approximate if threads log the same type concurrently)
+        second = int(default_timer())
+        rate = Log.__rates.get(kind)
+        if rate is None or rate[0] != second:
+            suppressed = 0 if rate is None else rate[2]
+            rate = [second, 0, suppressed]
+            Log.__rates[kind] = rate
+        rate[1] += 1
+        if rate[1] > Log.rate_max and level > 0:
+            rate[2] += 1
+            if rate[2] % Log.rate_sample != 0:
+                return
+        suppressed = rate[2]
+        rate[2] = 0
+        if Log.__queue is None:
+            Log.__start()
+        try:
+            Log.__queue.put_nowait((message, args, suppressed))
+        except queue.Full:
+            Log.__dropped += 1
+
+    @staticmethod
+    def __start():
+        with Log.__lock:
+            if Log.__queue is not None:
+                return
+            log_queue = queue.Queue(Log.queue_size)
+            writer = threading.Thread(target=Log.__writer, args=(log_queue,))
+            writer.daemon = True
+            writer.start()
+            Log.__queue = log_queue
+
+    @staticmethod
+    def __writer(log_queue):
+        while True:
+            (message, args, suppressed) = log_queue.get()
+            if args != ():
+                message = message % args
+            if suppressed > 0:
+                message += ' (%d similar suppressed)' % suppressed
+            dropped = Log.__dropped
+            if dropped > 0:
+                Log.__dropped -= dropped
+                message = '(%d log messages dropped)\n%s' % (dropped, message)
+            print(message)
+            sys.stdout.flush()
+            log_queue.task_done()
+
+    @staticmethod
+    def flush():
+        # wait for the pending log messages to be written
+        if Log.__queue is not None:
+            Log.__queue.join()
+
+class Stats(object):
+    # runtime metrics kept separately by each thread, so updates are not
+    # contended, with a snapshot combining all the threads when requested
+    histogram_buckets = 24 # powers of 2 microseconds
+    gauges_max = ('lake_lag',) # gauges combined with max instead of a sum
+    __local = threading.local()
+    __lock = threading.Lock()
+    __threads = []
+    __start = default_timer()
+    __snapshot_last = (__start, {})
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def local():
+        stats = getattr(Stats.__local, 'stats', None)
+        if stats is None:
+            stats = Stats()
+            Stats.__local.stats = stats
+            with Stats.__lock:
+                Stats.__threads.append(stats)
+        return stats
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    @staticmethod
+    def gauges_all(name):
+        # the current gauge values of all threads
+        with Stats.__lock:
+            threads = list(Stats.__threads)
+        return [stats.gauges[name] for stats in threads
+                if name in stats.gauges]
+
+    def latency(self, name, start):
+        # add the time elapsed since start to a histogram
+        elapsed = default_timer() - start
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = [0, 0.0, [0] * Stats.histogram_buckets]
+            self.histograms[name] = histogram
+        histogram[0] += 1
+        histogram[1] += elapsed
+        bucket = min(int(elapsed * 1000000).bit_length(),
+                     Stats.histogram_buckets - 1)
+        histogram[2][bucket] += 1
+
+    @staticmethod
+    def snapshot():
+        # combine the metrics of all threads as JSON
+        # (rates are per second since the previous snapshot)
+        now = default_timer()
+        with Stats.__lock:
+            threads = list(Stats.__threads)
+            (snapshot_last, counters_last) = Stats.__snapshot_last
+        counters = {}
+        gauges = {}
+        histograms = {}
+        for stats in threads:
+            for name, value in list(stats.counters.items()):
+                counters[name] = counters.get(name, 0) + value
+            for name, value in list(stats.gauges.items()):
+                if name in Stats.gauges_max:
+                    gauges[name] = max(gauges.get(name, 0), value)
+                else:
+                    gauges[name] = gauges.get(name, 0) + value
+            for name, histogram in list(stats.histograms.items()):
+                (count, total, buckets) = histogram
+                combined = histograms.get(name)
+                if combined is None:
+                    combined = [0, 0.0, [0] * Stats.histogram_buckets]
+                    histograms[name] = combined
+                combined[0] += count
+                combined[1] += total
+                for bucket, bucket_count in enumerate(list(buckets)):
+                    combined[2][bucket] += bucket_count
+        elapsed = max(now - snapshot_last, 0.001)
+        with Stats.__lock:
+            Stats.__snapshot_last = (now, counters)
+        return json.dumps({
+            'position': LakeState.position,
+            'uptime': now - Stats.__start,
+            'counters': counters,
+            'rates': dict(
+                (name, (value - counters_last.get(name, 0)) / elapsed)
+                for name, value in counters.items()
+            ),
+            'gauges': gauges,
+            'histograms': dict(
+                (name, {
+                    'count': count,
+                    'mean_ms': total * 1000.0 / count if count > 0 else 0.0,
+                    # upper bound (microseconds) -> count
+                    'buckets': dict(
+                        (str(2 ** bucket), bucket_count)
+                        for bucket, bucket_count in enumerate(buckets)
+                        if bucket_count > 0
+                    ),
+                })
+                for name, (count, total, buckets) in histograms.items()
+            ),
+        }, sort_keys=True).encode('utf-8')
+
+class Trace(object):
+    # append-only binary trace of the service requests received and sent
+    # (for replay with fish_replay.py)
+    path = '' # trace file path ({position} and {process} are replaced),
+              # disabled if empty
+    seed = 0 # random seed (0 uses a new random seed)
+    magic = b'FISHTRACE'
+    version = 1
+    # binary file format (little-endian):
+    #  magic, then a header of version, node position, random seed,
+    #  start time (time.time() seconds),
+    #  then records of kind, elapsed seconds, timeout, priority,
+    #  name size, request size, followed by the name and request
+    header = struct.Struct(b'<BHQd')
+    record = struct.Struct(b'<BdIbHI')
+    REQUEST = 1 # service request received
+    SEND_ASYNC = 2
+    FORWARD = 3
+    __lock = threading.Lock()
+    __started = False
+    __file = None
+    __start = None
+
+    @staticmethod
+    def start(position, process_index, process_count):
+        # seed random (and record the seed in the trace file, if enabled)
+        with Trace.__lock:
+            if Trace.__started:
+                return
+            Trace.__started = True
+            seed = Trace.seed
+            if seed == 0:
+                seed = random.SystemRandom().getrandbits(32)
+            random.seed(seed)
+            if numpy is not None:
+                numpy.random.seed(seed)
+            if Trace.path == '':
+                return
+            if process_count > 1 and '{process}' not in Trace.path:
+                # each OS process needs a separate trace file
+                Log.error('trace', 'trace path %s without {process} '
+                          'ignored', Trace.path)
+                return
+            trace_file = open(Trace.path.format(position=position,
+                                                process=process_index), 'ab')
+            trace_file.write(Trace.magic + Trace.header.pack(
+                Trace.version, position, seed, time.time(),
+            ))
+            Trace.__start = default_timer()
+            Trace.__file = trace_file
+
+    @staticmethod
+    def api(api):
+        # record the service requests of a CloudI API object
+        if Trace.__file is None:
+            return api
+        return TraceAPI(api)
+
+    @staticmethod
+    def add(kind, name, request, timeout, priority):
+        if isinstance(name, str):
+            name = name.encode('utf-8')
+        if timeout is None:
+            timeout = 0
+        if priority is None:
+            priority = 0
+        with Trace.__lock:
+            Trace.__file.write(Trace.record.pack(
+                kind, default_timer() - Trace.__start,
+                timeout, priority, len(name), len(request),
+            ) + name + request)
+
+    @staticmethod
+    def flush():
+        with Trace.__lock:
+            if Trace.__file is not None:
+                Trace.__file.flush()
+
+class TraceAPI(object):
+    # CloudI API object wrapper used when tracing
+    def __init__(self, api):
+        self.__api = api
+
+    def __getattr__(self, name):
+        return getattr(self.__api, name)
+
+    def subscribe(self, pattern, function):
+        def function_traced(request_type, name, pattern, request_info,
+                            request, timeout, priority, trans_id, pid):
+            # pylint: disable=too-many-arguments
+            Trace.add(Trace.REQUEST, name, request, timeout, priority)
+            return function(request_type, name, pattern, request_info,
+                            request, timeout, priority, trans_id, pid)
+        return self.__api.subscribe(pattern, function_traced)
+
+    def send_async(self, name, request,
+                   timeout=None, request_info=None, priority=None):
+        # pylint: disable=too-many-arguments
+        Trace.add(Trace.SEND_ASYNC, name, request, timeout, priority)
+        return self.__api.send_async(name, request, timeout=timeout,
+                                     request_info=request_info,
+                                     priority=priority)
+
+    def forward_(self, request_type, name, request_info, request,
+                 timeout, priority, trans_id, pid):
+        # pylint: disable=too-many-arguments
+        Trace.add(Trace.FORWARD, name, request, timeout, priority)
+        return self.__api.forward_(request_type, name, request_info, request,
+                                   timeout, priority, trans_id, pid)
+
+class FrameShard(object):
+    # pending lake position frame updates from a subset of the lake threads
+    # (only the latest UTF-8 character of each cell is kept, so a shard
+    #  never holds more than one frame per lake position between view ticks)
+    sequence = itertools.count(1)
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__frames = {}
+
+    def update(self, position, spans):
+        # spans is a list of (frame index, UTF-8 characters)
+        sequence = next(FrameShard.sequence)
+        with self.__lock:
+            frame = self.__frames.get(position)
+            if frame is None:
+                size = LakeState.columns * LakeState.rows
+                frame = ([None] * size, [0] * size)
+                self.__frames[position] = frame
+            (characters, sequences) = frame
+            for index, glyphs in spans:
+                index_end = index + len(glyphs)
+                characters[index:index_end] = glyphs
+                sequences[index:index_end] = [sequence] * len(glyphs)
+
+    def take(self):
+        with self.__lock:
+            frames = self.__frames
+            self.__frames = {}
+        return frames
+
+class FrameBuffer(object):
+    # pending lake position frames shared by all the OS processes of a node
+    # (CloudI count_process > 1) in a multiprocessing.shared_memory block,
+    # used instead of the FrameShard objects when enabled, so the lake
+    # threads of every process render into the view of process 0
+    enabled = False
+    name = 'odroid_fish_%d' # shared memory name of a lake position
+    attach_timeout = 10.0 # seconds to wait for process 0
+    # shared memory layout:
+    #  the OS process id of process 0,
+    #  (fish resident, lake lag milliseconds) gauges for each thread
+    #  of each process (for the hatchery of process 0),
+    #  a dirty flag byte for each lake position,
+    #  followed by (UTF-8 character (b'\0' padded), stamp) cells
+    #  for each lake position frame
+    #  (a stamp is unique for each update of each process, with the
+    #   process index + 1 in the low byte, so concurrent updates of a cell
+    #   always change the stamp that process 0 last read)
+    header = struct.Struct(b'<Q')
+    gauge = struct.Struct(b'<II')
+    cell = struct.Struct(b'<4sI')
+    gauges_count = 0 # count_process * count_thread (set by open)
+    process_index = 0
+    stamps = None # update counter (set by open)
+    memory = None
+    buffer = None
+    owner = False
+    lock = threading.Lock()
+    stamps_read = {} # lake position -> cell stamps read by process 0
+
+    @staticmethod
+    def open(process_index, process_count, thread_count):
+        # create (process 0) or attach to the shared memory block
+        # (called by every thread, only the first call opens it)
+        with FrameBuffer.lock:
+            if FrameBuffer.memory is not None:
+                return
+            assert process_count < 256
+            FrameBuffer.gauges_count = process_count * thread_count
+            FrameBuffer.process_index = process_index
+            FrameBuffer.stamps = itertools.count(
+                random.SystemRandom().getrandbits(24)
+            )
+            name = FrameBuffer.name % LakeState.position
+            size = FrameBuffer.__size()
+            if process_index == 0:
+                try:
+                    memory = FrameBuffer.__attach(name)
+                    if memory.size < size:
+                        memory.close()
+                        memory.unlink()
+                        raise OSError(name)
+                    Log.info('framebuffer', 'reusing %s', name)
+                except OSError:
+                    memory = shared_memory.SharedMemory(name, create=True,
+                                                        size=size)
+                memory.buf[:size] = b'\0' * size
+                FrameBuffer.header.pack_into(memory.buf, 0, os.getpid())
+                FrameBuffer.owner = True
+            else:
+                end = default_timer() + FrameBuffer.attach_timeout
+                while True:
+                    try:
+                        memory = FrameBuffer.__attach(name)
+                        break
+                    except OSError:
+                        if default_timer() > end:
+                            raise
+                        time.sleep(0.1)
+            FrameBuffer.memory = memory
+            FrameBuffer.buffer = memory.buf
+
+    @staticmethod
+    def __attach(name):
+        memory = shared_memory.SharedMemory(name)
+        if (memory.size >= FrameBuffer.header.size and
+            FrameBuffer.header.unpack_from(memory.buf)[0] != os.getpid()):
+            try:
+                # only process 0 removes the shared memory block
+                # (Python < 3.13 unlinks an attached block at process exit)
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(
+                    getattr(memory, '_name', '/' + name), 'shared_memory'
+                )
+            except (ImportError, AttributeError, KeyError):
+                pass
+        return memory
+
+    @staticmethod
+    def close():
+        with FrameBuffer.lock:
+            memory = FrameBuffer.memory
+            if memory is None:
+                return
+            FrameBuffer.buffer = None
+            FrameBuffer.memory = None
+            FrameBuffer.stamps_read = {}
+            memory.close()
+            if FrameBuffer.owner:
+                memory.unlink()
+                FrameBuffer.owner = False
+
+    @staticmethod
+    def __size():
+        count = LakeState.nodes_x * LakeState.nodes_y
+        return FrameBuffer.__offset(count)
+
+    @staticmethod
+    def __offset_dirty():
+        return (FrameBuffer.header.size +
+                FrameBuffer.gauges_count * FrameBuffer.gauge.size)
+
+    @staticmethod
+    def __offset(position):
+        count = LakeState.nodes_x * LakeState.nodes_y
+        return (FrameBuffer.__offset_dirty() + count +
+                position * LakeState.columns * LakeState.rows *
+                FrameBuffer.cell.size)
+
+    @staticmethod
+    def gauges_set(gauge_index, fish_resident, lake_lag):
+        # the gauges of a thread (gauge_index is unique for each thread)
+        FrameBuffer.gauge.pack_into(
+            FrameBuffer.buffer,
+            FrameBuffer.header.size + gauge_index * FrameBuffer.gauge.size,
+            min(fish_resident, 0xffffffff), min(lake_lag, 0xffffffff),
+        )
+
+    @staticmethod
+    def gauges():
+        # (fish resident, lake lag milliseconds) of every thread
+        return [FrameBuffer.gauge.unpack_from(
+            FrameBuffer.buffer,
+            FrameBuffer.header.size + gauge_index * FrameBuffer.gauge.size,
+        ) for gauge_index in range(FrameBuffer.gauges_count)]
+
+    @staticmethod
+    def update(position, spans):
+        # spans is a list of (frame index, UTF-8 characters)
+        buffer = FrameBuffer.buffer
+        cell = FrameBuffer.cell
+        stamp = (((next(FrameBuffer.stamps) << 8) & 0xffffffff) |
+                 (FrameBuffer.process_index + 1))
+        offset_frame = FrameBuffer.__offset(position)
+        for index, glyphs in spans:
+            offset = offset_frame + index * cell.size
+            for glyph in glyphs:
+                cell.pack_into(buffer, offset, glyph, stamp)
+                offset += cell.size
+        # set after the cells, so process 0 reads the cells again
+        buffer[FrameBuffer.__offset_dirty() + position] = 1
+
+    @staticmethod
+    def dirty():
+        buffer = FrameBuffer.buffer
+        if buffer is None:
+            return False
+        offset = FrameBuffer.__offset_dirty()
+        return any(buffer[offset:
+                          offset + LakeState.nodes_x * LakeState.nodes_y])
+
+    @staticmethod
+    def take():
+        # the cells changed since the previous take of each lake position
+        # (the same result as combining the FrameShard objects)
+        buffer = FrameBuffer.buffer
+        cell = FrameBuffer.cell
+        size = LakeState.columns * LakeState.rows
+        frames = {}
+        for position in range(LakeState.nodes_x * LakeState.nodes_y):
+            dirty = FrameBuffer.__offset_dirty() + position
+            if not buffer[dirty]:
+                continue
+            buffer[dirty] = 0
+            stamps_read = FrameBuffer.stamps_read.get(position)
+            if stamps_read is None:
+                stamps_read = [0] * size
+                FrameBuffer.stamps_read[position] = stamps_read
+            frame = None
+            offset = FrameBuffer.__offset(position)
+            for index in range(size):
+                (glyph, stamp) = cell.unpack_from(buffer, offset)
+                offset += cell.size
+                if stamp == stamps_read[index]:
+                    continue
+                stamps_read[index] = stamp
+                if frame is None:
+                    frame = [b'\0'] * size
+                frame[index] = glyph.rstrip(b'\0')
+            if frame is not None:
+                frames[position] = frame
+        return frames
+
+class FrameEncoding(object):
+    # display/merge frames with runs of unchanged cells skipped
+    # (a keyframe skips the transparent cells, a delta frame skips the cells
+    #  that are the same as the previous frame sent to the lake position
+    #  and is only used when it is smaller than the keyframe)
+    keyframe_interval = 10 # maximum frames between keyframes
+    encoding_version = 1
+    keyframe = 1 # flag
+    # binary wire format (little-endian):
+    #  version, flags, LEDs, source lake position, frame cells,
+    #  followed by (skip cells, literal cells, literal UTF-8 characters)
+    #  for each run (cells after the last run are unchanged)
+    encoding = struct.Struct(b'<BBBBH')
+    encoding_run = struct.Struct(b'<BB')
+    frames_sent = {} # lake position -> (frame, frames since the keyframe)
+
+    @staticmethod
+    def deltas(api):
+        # the display decodes the deltas of each source lake position,
+        # so only one OS process of the node may send deltas
+        # (the other processes only send keyframes without the FrameBuffer)
+        return api.process_count() == 1 or FrameBuffer.buffer is not None
+
+    @staticmethod
+    def encode(position, frame, leds, deltas=True):
+        # frame is a list of UTF-8 characters (b'\0' is transparent)
+        flags = FrameEncoding.keyframe
+        runs = FrameEncoding.__runs(frame, [b'\0'] * len(frame))
+        (frame_sent, count) = FrameEncoding.frames_sent.get(position,
+                                                            (None, 0))
+        if (deltas and frame_sent is not None and
+            len(frame_sent) == len(frame) and
+            count < FrameEncoding.keyframe_interval):
+            runs_delta = FrameEncoding.__runs(frame, frame_sent)
+            if len(runs_delta) < len(runs):
+                flags = 0
+                runs = runs_delta
+        if flags & FrameEncoding.keyframe:
+            count = 0
+        FrameEncoding.frames_sent[position] = (frame, count + 1)
+        return FrameEncoding.encoding.pack(
+            FrameEncoding.encoding_version, flags, leds,
+            LakeState.position, len(frame),
+        ) + runs
+
+    @staticmethod
+    def __runs(frame, frame_base):
+        data = []
+        i = 0
+        cells = len(frame)
+        while i < cells:
+            skip = 0
+            while i < cells and frame[i] == frame_base[i] and skip < 255:
+                skip += 1
+                i += 1
+            literal_start = i
+            while (i < cells and frame[i] != frame_base[i] and
+                   i - literal_start < 255):
+                i += 1
+            if i == cells and i == literal_start:
+                break
+            data.append(FrameEncoding.encoding_run.pack(skip,
+                                                        i - literal_start))
+            data.extend(frame[literal_start:i])
+        return b''.join(data)
+
+    @staticmethod
+    def decode(data, frames):
+        # reference decoder, returning (source lake position, LEDs, frame)
+        # or None if the frame is a delta without a previous frame
+        # (frames is the source lake position -> frame storage of the caller)
+        (version, flags, leds,
+         position, cells) = FrameEncoding.encoding.unpack_from(data)
+        assert version == FrameEncoding.encoding_version
+        if flags & FrameEncoding.keyframe:
+            frame = [b'\0'] * cells
+        else:
+            frame_previous = frames.get(position)
+            if frame_previous is None:
+                return None
+            frame = list(frame_previous)
+        i = FrameEncoding.encoding.size
+        index = 0
+        while i < len(data):
+            (skip,
+             literal) = FrameEncoding.encoding_run.unpack_from(data, i)
+            i += FrameEncoding.encoding_run.size
+            index += skip
+            for _ in range(literal):
+                lead = ord(data[i:i + 1])
+                if lead < 0x80:
+                    size = 1
+                elif lead < 0xe0:
+                    size = 2
+                elif lead < 0xf0:
+                    size = 3
+                else:
+                    size = 4
+                frame[index] = data[i:i + size]
+                i += size
+                index += 1
+        frames[position] = frame
+        return (position, leds, frame)
+
+class Scheduler(object):
+    # events due at a time (default_timer() seconds), used only by the
+    # thread that owns the scheduler (so no locking is necessary)
+    timeout_max = 50 # milliseconds (a poll is not interrupted by a
+                     # service request that adds an earlier event)
+
+    def __init__(self):
+        self.__events = []
+        self.__sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.__events)
+
+    def add(self, due, event):
+        heapq.heappush(self.__events, (due, next(self.__sequence), event))
+
+    def events(self):
+        # all the events, in no particular order
+        return [event for (_, _, event) in self.__events]
+
+    def due(self, now):
+        # remove the events that are due
+        events = []
+        while self.__events != [] and self.__events[0][0] <= now:
+            events.append(heapq.heappop(self.__events)[2])
+        return events
+
+    def timeout(self, now):
+        # milliseconds until the next event is due
+        if self.__events == []:
+            return Scheduler.timeout_max
+        return min(max(0, int((self.__events[0][0] - now) * 1000) + 1),
+                   Scheduler.timeout_max)
 
 class LakeState(object):
     position = None
-    rows = 2
-    columns = 16
-    frames = {
-        0: [],
-        1: [],
-        2: [],
-        3: [],
-    }
+    rows = 2 # per node display
+    columns = 16 # per node display
+    nodes_x = 2
+    nodes_y = 2
+    frame_rate = 1.0 # maximum frames per second sent to each display
+    frame_encoding = 'full' # display/merge format ('full' or 'delta')
+    led_count = 7 # display status LEDs
+    shards = [FrameShard() for _ in range(8)]
+    dirty = False # pending frames exist
+    shard_local = threading.local()
+    shard_count = itertools.count()
+    # lookup tables created by set_position
+    x_mins = None
+    x_maxs = None
+    y_mins = None
+    y_maxs = None
+    xy_locals = None
+    column_spans = None
 
     @staticmethod
     def set_position(prefix):
         path = prefix.split('/')
         assert len(path) == 5 # '/odroid/fish/#/'
         assert '/'.join(path[0:3]) == '/odroid/fish'
-        # positioning is based on 4 numbers:
+        # positioning is based on nodes_x * nodes_y numbers
+        # (shown below for the default of 4 numbers):
         # X(max)                  X/Y (min)
         #           2        0
         #
         #           3        1
         #                           Y (max)
-        LakeState.position = int(path[3])
+        position = int(path[3])
+        assert 0 <= position < LakeState.nodes_x * LakeState.nodes_y
+        # fish are hatched within a node display,
+        # so it must be wider than the widest fish
+        view_x_size_max = max(
+            len(FishState.fish(position_hatched, type_id, look_x_min))
+            for position_hatched in range(LakeState.nodes_x *
+                                          LakeState.nodes_y)
+            for type_id in range(3)
+            for look_x_min in range(2)
+        )
+        assert LakeState.columns > view_x_size_max, \
+            'LakeState.columns must be more than %d' % view_x_size_max
+        LakeState.__topology()
+        LakeState.position = position
+
+    @staticmethod
+    def __topology():
+        # precompute the node position lookup tables
+        x_mins = []
+        x_maxs = []
+        y_mins = []
+        y_maxs = []
+        for position in range(LakeState.nodes_x * LakeState.nodes_y):
+            x_node = position // LakeState.nodes_y
+            y_node = position % LakeState.nodes_y
+            x_mins.append(LakeState.columns * x_node)
+            x_maxs.append(LakeState.columns * (x_node + 1) - 1)
+            y_mins.append(LakeState.rows * y_node)
+            y_maxs.append(LakeState.rows * (y_node + 1) - 1)
+        xy_locals = []
+        for y_lake in range(LakeState.rows * LakeState.nodes_y):
+            y_node = y_lake // LakeState.rows
+            xy_locals.append([
+                (x_lake // LakeState.columns * LakeState.nodes_y + y_node,
+                 x_lake % LakeState.columns,
+                 y_lake % LakeState.rows)
+                for x_lake in range(LakeState.columns * LakeState.nodes_x)
+            ])
+        LakeState.x_mins = x_mins
+        LakeState.x_maxs = x_maxs
+        LakeState.y_mins = y_mins
+        LakeState.y_maxs = y_maxs
+        LakeState.xy_locals = xy_locals
+        LakeState.column_spans = {}
 
     @staticmethod
     def prefix(position):
@@ -72,7 +907,7 @@ class LakeState(object):
 
     @staticmethod
     def x_boundary_max():
-        return LakeState.columns * 2 - 1
+        return LakeState.columns * LakeState.nodes_x - 1
 
     @staticmethod
     def y_boundary_min():
@@ -80,132 +915,188 @@ class LakeState(object):
 
     @staticmethod
     def y_boundary_max():
-        return LakeState.rows * 2 - 1
+        return LakeState.rows * LakeState.nodes_y - 1
 
     @staticmethod
     def x_min(position=None):
         if position is None:
             position = LakeState.position
-        return {
-            0: LakeState.columns * 0,
-            1: LakeState.columns * 0,
-            2: LakeState.columns * 1,
-            3: LakeState.columns * 1,
-        }[position]
+        return LakeState.x_mins[position]
 
     @staticmethod
     def x_max(position=None):
         if position is None:
             position = LakeState.position
-        return {
-            0: LakeState.columns * 1 - 1,
-            1: LakeState.columns * 1 - 1,
-            2: LakeState.columns * 2 - 1,
-            3: LakeState.columns * 2 - 1,
-        }[position]
+        return LakeState.x_maxs[position]
 
     @staticmethod
     def y_min(position=None):
         if position is None:
             position = LakeState.position
-        return {
-            0: LakeState.rows * 0,
-            1: LakeState.rows * 1,
-            2: LakeState.rows * 0,
-            3: LakeState.rows * 1,
-        }[position]
+        return LakeState.y_mins[position]
 
     @staticmethod
     def y_max(position=None):
         if position is None:
             position = LakeState.position
-        return {
-            0: LakeState.rows * 1 - 1,
-            1: LakeState.rows * 2 - 1,
-            2: LakeState.rows * 1 - 1,
-            3: LakeState.rows * 2 - 1,
-        }[position]
+        return LakeState.y_maxs[position]
 
     @staticmethod
     def xy_local(x_lake, y_lake):
-        y_size = LakeState.rows * 1
-        x_size = LakeState.columns * 1
-        if x_lake <= (LakeState.columns * 1 - 1):
-            if y_lake <= (LakeState.rows * 1 - 1):
-                return (0, x_lake, y_lake)
-            elif y_lake <= (LakeState.rows * 2 - 1):
-                return (1, x_lake, y_lake - y_size)
-        elif x_lake <= (LakeState.columns * 2 - 1):
-            if y_lake <= (LakeState.rows * 1 - 1):
-                return (2, x_lake - x_size, y_lake)
-            elif y_lake <= (LakeState.rows * 2 - 1):
-                return (3, x_lake - x_size, y_lake - y_size)
-        return (None, None, None)
-
-    @staticmethod
-    def __printable_frame(frame, x_size=None):
-        if x_size is None:
-            x_size = LakeState.x_boundary_max() - LakeState.x_boundary_min() + 1
+        if (x_lake < 0 or x_lake > LakeState.x_boundary_max() or
+            y_lake < 0 or y_lake > LakeState.y_boundary_max()):
+            return (None, None, None)
+        return LakeState.xy_locals[y_lake][x_lake]
+
+    @staticmethod
+    def __printable_frame(frame):
+        x_size = LakeState.columns
         rows = []
-        for x_lake in range(0, len(frame), x_size):
-            row = frame[x_lake:x_lake + x_size]
-            if isinstance(row, list):
-                row = u''.join(row)
+        for x_local in range(0, len(frame), x_size):
+            row = b''.join(frame[x_local:x_local + x_size]).decode('utf-8')
             rows.append(u'"' +
                         row.replace(u' ', u'_').replace(u'\0', u' ') +
                         u'"\n')
         return u''.join(rows)
 
     @staticmethod
-    def show(positions, frame):
-        # show frames for each lake position separately
-        print(u'all positions:\n%s' % (LakeState.__printable_frame(frame),))
-        for position in positions:
-            x_min = LakeState.x_min(position)
-            x_max = LakeState.x_max(position)
-            y_min = LakeState.y_min(position)
-            y_max = LakeState.y_max(position)
-            frame_position = []
-            x_size = LakeState.x_boundary_max() - LakeState.x_boundary_min() + 1
-            for y_lake in range(y_min, y_max + 1):
-                frame_position.extend(
-                    frame[(x_size - 1) - x_max + x_size * y_lake:
-                          (x_size - 1) - x_min + x_size * y_lake + 1]
-                )
-            print(u'position(%d) (frame x = [%d..%d], y = [%d..%d]):\n%s' % (
-                position,
-                x_min, x_max, y_min, y_max,
-                LakeState.__printable_frame(frame_position,
-                                            x_size=(x_max - x_min + 1)),
-            ))
-            LakeState.frames[position].append(
-                u''.join(frame_position).encode('utf-8')
-            )
+    def shard():
+        # each lake thread uses a separate frame shard to avoid contention
+        shard = getattr(LakeState.shard_local, 'shard', None)
+        if shard is None:
+            shard = LakeState.shards[next(LakeState.shard_count) %
+                                     len(LakeState.shards)]
+            LakeState.shard_local.shard = shard
+        return shard
+
+    @staticmethod
+    def __column_spans(x_lake, x_size):
+        # glyphs [i0..i1) of a view with x_size glyphs, drawn from x_lake
+        # toward x min, that are within each node column
+        # (as (x node, i0, i1, frame index of i0 in the node's first row))
+        column_spans = []
+        for x_node in range(LakeState.nodes_x):
+            x_min = LakeState.columns * x_node
+            x_max = x_min + LakeState.columns - 1
+            i0 = max(0, x_lake - x_max)
+            i1 = min(x_size, x_lake - x_min + 1)
+            if i0 < i1:
+                column_spans.append((
+                    x_node, i0, i1,
+                    (LakeState.columns - 1) - (x_lake - i0 - x_min),
+                ))
+        return column_spans
+
+    @staticmethod
+    def draw(spans, x_lake, y_lake, glyphs):
+        # add the (position, frame index, UTF-8 characters) spans
+        # of a view (or its erasure) within the lake
+        if y_lake < 0 or y_lake > LakeState.y_boundary_max():
+            return
+        key = (x_lake, len(glyphs))
+        column_spans = LakeState.column_spans.get(key)
+        if column_spans is None:
+            column_spans = LakeState.__column_spans(x_lake, len(glyphs))
+            LakeState.column_spans[key] = column_spans
+        y_node = y_lake // LakeState.rows
+        y_index = LakeState.columns * (y_lake % LakeState.rows)
+        for (x_node, i0, i1, index) in column_spans:
+            spans.append((x_node * LakeState.nodes_y + y_node,
+                          index + y_index, glyphs[i0:i1]))
+
+    @staticmethod
+    def show(spans):
+        # apply changed spans (position, frame index, UTF-8 characters)
+        # to the pending frame for each lake position separately
+        frames = {}
+        for (position, index, glyphs) in spans:
+            frame = frames.get(position)
+            if frame is None:
+                frame = []
+                frames[position] = frame
+            frame.append((index, glyphs))
+        if FrameBuffer.buffer is not None:
+            for position, frame in frames.items():
+                FrameBuffer.update(position, frame)
+            return
+        shard = LakeState.shard()
+        for position, frame in frames.items():
+            shard.update(position, frame)
+        if frames != {}:
+            LakeState.dirty = True
+
+    @staticmethod
+    def __compose():
+        # merge the pending frames of all the shards into a single frame
+        # for each lake position, with the most recent character of each cell
+        if FrameBuffer.buffer is not None:
+            return FrameBuffer.take()
+        pending = {}
+        for shard in LakeState.shards:
+            for position, frame in shard.take().items():
+                frame_pending = pending.get(position)
+                if frame_pending is None:
+                    pending[position] = frame
+                    continue
+                (characters_pending, sequences_pending) = frame_pending
+                (characters, sequences) = frame
+                for index, sequence in enumerate(sequences):
+                    if sequence > sequences_pending[index]:
+                        characters_pending[index] = characters[index]
+                        sequences_pending[index] = sequence
+        frames = {}
+        for position, (characters, _) in pending.items():
+            frames[position] = [b'\0' if character is None else character
+                                for character in characters]
+        return frames
+
+    @staticmethod
+    def leds():
+        # the display LED toggled by this node position
+        # (more node positions than LEDs share the LEDs)
+        return 2 ** (LakeState.position % LakeState.led_count)
 
     @staticmethod
     def tick(api):
-        # display merged frames of the lake for each position
+        # display merged frames of the lake for each position,
+        # returning when the next tick is due (default_timer() seconds)
         now = default_timer()
+        if not LakeState.dirty and not FrameBuffer.dirty():
+            # check again after the next poll
+            return now + Scheduler.timeout_max / 1000.0
+        LakeState.dirty = False
+        stats = Stats.local()
         positions = []
-        for position, frames in LakeState.frames.items():
-            if frames != []:
-                positions.append(position)
-                frames_binary = b''.join([
-                    struct.pack(b'<IBBB', len(frame) + 3,
-                                0, 0, 2 ** LakeState.position) + frame
-                    for frame in frames
-                ])
-                api.send_async(
-                    LakeState.prefix(position) + 'display/merge',
-                    frames_binary,
-                    timeout=10000,
+        for position, frame in sorted(LakeState.__compose().items()):
+            positions.append(position)
+            if Log.frames:
+                Log.info(
+                    'frame',
+                    u'position(%d) (frame x = [%d..%d], y = [%d..%d]):\n%s',
+                    position,
+                    LakeState.x_min(position), LakeState.x_max(position),
+                    LakeState.y_min(position), LakeState.y_max(position),
+                    LakeState.__printable_frame(frame),
                 )
-                del LakeState.frames[position][:]
+            if LakeState.frame_encoding == 'delta':
+                request = FrameEncoding.encode(position, frame,
+                                               LakeState.leds(),
+                                               FrameEncoding.deltas(api))
+            else:
+                frame = b''.join(frame)
+                request = struct.pack(b'<IBBB', len(frame) + 3,
+                                      0, 0, LakeState.leds()) + frame
+            api.send_async(
+                LakeState.prefix(position) + 'display/merge',
+                request,
+                timeout=10000,
+            )
+            stats.count('view_bytes', len(request))
+        stats.count('view_ticks')
+        stats.count('view_frames', len(positions))
         if positions != []:
-            print('sent frames for positions %s' % str(positions))
-        elapsed = default_timer() - now
-        if elapsed < 1.0:
-            time.sleep(1.0 - elapsed)
+            Log.debug('view', 'sent frames for positions %s', str(positions))
+        return now + 1.0 / LakeState.frame_rate
 
 class FishState(object):
     move_rate_min = 500 # every 500 milliseconds
@@ -213,21 +1104,58 @@ class FishState(object):
     move_y_chance = 0.10 # % of the time
     move_x_flip_chance = 0.60 # % of the time
     timeout_death = 2000 # milliseconds
+    catch_up_lag = 250 # milliseconds late before missed moves are
+                       # rendered together as a single move
+    encoding_json = False # send legacy JSON to older nodes?
+    encoding_version = 2
+    # binary wire format (little-endian):
+    #  version, position_hatched, type_id, look_x_min, move_y_min,
+    #  x, y, move_rate, move_next (milliseconds until the next move,
+    #                              so no clock synchronization is necessary)
+    encoding = struct.Struct(b'<BBBBBhhHH')
+    # version 1 from older nodes:
+    #  ..., move_rate, move_count, move_start (NaN if unset)
+    encoding_v1 = struct.Struct(b'<BBBBBhhHId')
+    atlas = {}
+    erasures = {}
+
+    @staticmethod
+    def sprite(position_hatched, type_id, look_x_min):
+        # (view, UTF-8 characters of the view) from the sprite atlas
+        key = (position_hatched, type_id, look_x_min)
+        sprite = FishState.atlas.get(key)
+        if sprite is None:
+            # ascii art inspired by https://github.com/lericson/fish
+            fish_format = {
+                0: [u"<°(%d<", u">%d)°>"], # bass
+                1: [u"<·}}%d→<", u">←%d{{·>"], # salmon
+                2: [u"<θ]]]]%d→<", u">←%d[[[[θ>"], # carp
+            }[type_id][look_x_min]
+            view = fish_format % position_hatched
+            sprite = (view, tuple(character.encode('utf-8')
+                                  for character in view))
+            FishState.atlas[key] = sprite
+        return sprite
+
+    @staticmethod
+    def atlas_create():
+        # create the sprite atlas of all the fish hatched within the lake
+        for position in range(LakeState.nodes_x * LakeState.nodes_y):
+            for type_id in range(3):
+                for look_x_min in range(2):
+                    FishState.sprite(position, type_id, look_x_min)
 
     @staticmethod
     def fish(position_hatched, type_id, look_x_min):
-        # ascii art inspired by https://github.com/lericson/fish
-        fish_format = {
-            0: [u"<°(%d<", u">%d)°>"], # bass
-            1: [u"<·}}%d→<", u">←%d{{·>"], # salmon
-            2: [u"<θ]]]]%d→<", u">←%d[[[[θ>"], # carp
-        }[type_id][look_x_min]
-        return fish_format % position_hatched
-
-    def __init__(self, data_json=None):
-        if data_json is not None:
+        return FishState.sprite(position_hatched, type_id, look_x_min)[0]
+
+    def __init__(self, data=None, transit=0):
+        if data is not None:
             # an older fish
-            data_json = json.loads(data_json)
+            # (transit is the milliseconds since the fish was encoded)
+            start = default_timer()
+            self.__data = FishState.__decode(data, transit)
+            Stats.local().latency('decode', start)
         else:
             # a fish is born
             position = LakeState.position
@@ -242,37 +1170,99 @@ class FishState(object):
                 x_lake = random.randint(LakeState.x_min(),
                                         LakeState.x_max() - view_x_size)
             else:
-                # only would happen with more than 4 nodes
+                # only would happen with more than 2 nodes along x
                 x_lake = random.randint(LakeState.x_min(),
                                         LakeState.x_max())
             y_lake = random.randint(LakeState.y_min(),
                                     LakeState.y_max())
-            data_json = {
-                'fish': {
-                    'position_hatched': position,
-                    'type_id': type_id,
-                    'look_x_min': look_x_min,
-                    'view': view,
-                    'view_x_size': view_x_size,
-                    'view_x_center': int(round(view_x_size * 0.5)),
-                    'x': x_lake,
-                    'y': y_lake,
-                    'move_rate': random.randint(FishState.move_rate_min,
-                                                FishState.move_rate_max),
-                    'move_start': default_timer(),
-                    'move_y_min': random.randint(0, 1),
-                    'move_count': 0,
-                },
+            self.__data = {
+                'position_hatched': position,
+                'type_id': type_id,
+                'look_x_min': look_x_min,
+                'view': view,
+                'view_x_size': view_x_size,
+                'view_x_center': int(round(view_x_size * 0.5)),
+                'x': x_lake,
+                'y': y_lake,
+                'move_rate': random.randint(FishState.move_rate_min,
+                                            FishState.move_rate_max),
+                'move_start': default_timer(),
+                'move_y_min': random.randint(0, 1),
+                'move_count': 0,
             }
-        self.__data = data_json['fish']
 
-    def __str__(self):
-        return json.dumps({'fish': self.__data})
+    def encode(self, binary=False):
+        # the fish view is derived from (position_hatched, type_id, look_x_min)
+        # so it is not part of the binary wire format
+        # (binary is set when the fish is within a fixed-size record)
+        start = default_timer()
+        data = self.__data
+        if FishState.encoding_json and not binary:
+            # older nodes use a move_start from their own clock
+            data = dict(data)
+            data['move_start'] = None
+            encoded = json.dumps({'fish': data}).encode('utf-8')
+        else:
+            if data['move_start'] is None:
+                move_next = data['move_rate']
+            else:
+                move_next = min(max(0, int(
+                    (self.move_next() - start) * 1000
+                )), data['move_rate'])
+            encoded = FishState.encoding.pack(
+                FishState.encoding_version,
+                data['position_hatched'], data['type_id'],
+                data['look_x_min'], data['move_y_min'],
+                data['x'], data['y'], data['move_rate'],
+                move_next,
+            )
+        Stats.local().latency('encode', start)
+        return encoded
+
+    @staticmethod
+    def __decode(data, transit):
+        if data[0:1] == b'{':
+            # legacy JSON from an older node
+            return json.loads(data.decode('utf-8'))['fish']
+        if data[0:1] == b'\x01':
+            # version 1 from an older node
+            (_,
+             position_hatched, type_id,
+             look_x_min, move_y_min,
+             x_lake, y_lake, move_rate,
+             _, _) = FishState.encoding_v1.unpack(data)
+            move_start = None
+        else:
+            (version,
+             position_hatched, type_id,
+             look_x_min, move_y_min,
+             x_lake, y_lake, move_rate,
+             move_next) = FishState.encoding.unpack(data)
+            assert version == FishState.encoding_version
+            # the next move keeps the progress made before the handoff
+            move_next = max(0, move_next - transit)
+            move_start = default_timer() + (move_next - move_rate) / 1000.0
+        view = FishState.fish(position_hatched, type_id, look_x_min)
+        view_x_size = len(view)
+        return {
+            'position_hatched': position_hatched,
+            'type_id': type_id,
+            'look_x_min': look_x_min,
+            'view': view,
+            'view_x_size': view_x_size,
+            'view_x_center': int(round(view_x_size * 0.5)),
+            'x': x_lake,
+            'y': y_lake,
+            'move_rate': move_rate,
+            'move_start': move_start,
+            'move_y_min': move_y_min,
+            'move_count': 0,
+        }
 
     def tick(self, timeout):
         # move and render a fish in a lake
         if timeout <= FishState.timeout_death:
-            self.__render_dead()
+            self.render_dead()
             return None
         now = default_timer()
         if self.__data['move_start'] is None:
@@ -287,50 +1277,73 @@ class FishState(object):
         move_count = self.__data['move_count']
         count = (elapsed // self.__data['move_rate']) - move_count
         if count <= 0:
-            time.sleep(0.1)
             return LakeState.position
+        # the lake threads are behind if the first move is late enough,
+        # so only the final position of the missed moves is rendered
+        lag = elapsed - (move_count + 1) * self.__data['move_rate']
+        catch_up = count > 1 and lag >= FishState.catch_up_lag
+        x_lake_old = self.__data['x']
+        y_lake_old = self.__data['y']
+        moves = 0
         for _ in range(count):
-            move_count += 1
-            position = self.__render_move()
+            moves += 1
+            position = self.__render_move(not catch_up)
             if position != LakeState.position:
                 break
-        self.__data['move_count'] = move_count
+        self.__data['move_count'] = move_count + moves
+        stats = Stats.local()
+        stats.count('moves', moves)
+        if catch_up:
+            self.render(x_lake_old, y_lake_old)
+            stats.count('moves_collapsed', moves - 1)
         if position is None:
-            self.__render_dead()
+            self.render_dead()
             return None
         return position
 
-    def __render_dead(self):
-        # pylint: disable=too-many-locals
+    def move_next(self):
+        # time of the next move (default_timer() seconds)
+        return (self.__data['move_start'] +
+                (self.__data['move_count'] + 1) *
+                self.__data['move_rate'] / 1000.0)
+
+    @staticmethod
+    def __erasure(view_x_size):
+        glyphs = FishState.erasures.get(view_x_size)
+        if glyphs is None:
+            glyphs = (b' ',) * view_x_size
+            FishState.erasures[view_x_size] = glyphs
+        return glyphs
 
+    def data(self):
+        # fish data that is updated by the LakeEngine
+        return self.__data
+
+    def render(self, x_lake_old, y_lake_old):
+        # render only the cells that changed
+        data = self.__data
+        (_, glyphs) = FishState.sprite(data['position_hatched'],
+                                       data['type_id'], data['look_x_min'])
+        spans = []
+        LakeState.draw(spans, x_lake_old, y_lake_old,
+                       FishState.__erasure(data['view_x_size']))
+        LakeState.draw(spans, data['x'], data['y'], glyphs)
+        LakeState.show(spans)
+
+    def render_dead(self):
         # render the fish disappearing
-        #view = self.__data['view']
-        view_x_size = self.__data['view_x_size']
         x_lake_old = self.__data['x']
         y_lake_old = self.__data['y']
-        x_min = LakeState.x_boundary_min()
-        x_max = LakeState.x_boundary_max()
-        y_min = LakeState.y_boundary_min()
-        y_max = LakeState.y_boundary_max()
 
-        print('dead fish (%d, %d)' % (x_lake_old, y_lake_old))
-        positions = set()
-        x_size = x_max - x_min + 1
-        y_size = y_max - y_min + 1
-        frame = [u'\0'] * (x_size * y_size)
-        for i in range(view_x_size):
-            x_array = (x_lake_old - i)
-            if x_array >= 0 and x_array < x_size:
-                frame[(x_size - 1) - x_array + x_size * y_lake_old] = u' '
-                (position,
-                 _, _) = LakeState.xy_local(x_lake_old - i, y_lake_old)
-                positions.add(position)
-        LakeState.show(positions, frame)
-
-    def __render_move(self):
+        Log.debug('dead', 'dead fish (%d, %d)', x_lake_old, y_lake_old)
+        spans = []
+        LakeState.draw(spans, x_lake_old, y_lake_old,
+                       FishState.__erasure(self.__data['view_x_size']))
+        LakeState.show(spans)
+
+    def __render_move(self, render=True):
         # pylint: disable=too-many-locals
         # pylint: disable=too-many-branches
-        # pylint: disable=too-many-statements
 
         # move fish
         position_hatched = self.__data['position_hatched']
@@ -379,167 +1392,840 @@ class FishState(object):
         self.__data['x'] = x_lake
         self.__data['y'] = y_lake
 
-        print('moved fish (%d, %d) -> (%d, %d)' % (
-            x_lake_old, y_lake_old, x_lake, y_lake,
-        ))
-        # render
-        positions = set()
-        x_size = x_max - x_min + 1
-        y_size = y_max - y_min + 1
-        frame = [u'\0'] * (x_size * y_size)
-        for i in range(view_x_size):
-            x_array = (x_lake_old - i)
-            if x_array >= 0 and x_array < x_size:
-                frame[(x_size - 1) - x_array + x_size * y_lake_old] = u' '
-                (position,
-                 _, _) = LakeState.xy_local(x_lake_old - i, y_lake_old)
-                positions.add(position)
-        for i, character in enumerate(view):
-            x_array = (x_lake - i)
-            if x_array >= 0 and x_array < x_size:
-                frame[(x_size - 1) - x_array + x_size * y_lake] = character
-                (position, _, _) = LakeState.xy_local(x_lake - i, y_lake)
-                positions.add(position)
-        LakeState.show(positions, frame)
+        Log.debug('move', 'moved fish (%d, %d) -> (%d, %d)',
+                  x_lake_old, y_lake_old, x_lake, y_lake)
+        if render:
+            self.render(x_lake_old, y_lake_old)
 
         # return updated position to determine the fish's next destination
         if x_lake >= x_min and x_lake - (view_x_size - 1) <= x_max:
             (position,
-             _, _) = LakeState.xy_local(x_lake - view_x_center, y_lake)
-            if position is None:
-                position = LakeState.position
-            elif position != LakeState.position:
-                self.__data['move_start'] = None # remote node time is different
+             _, _) = LakeState.xy_local(
+                min(max(x_lake - view_x_center, x_min), x_max), y_lake
+            )
             return position
         else:
             return None
 
+class LakeEngine(object):
+    # vectorized movement of all the fish resident in a lake thread,
+    # using the same movement rules as FishState (requires numpy)
+    enabled = False
+    fields = ('x', 'y', 'look_x_min', 'move_y_min', 'move_rate',
+              'move_count', 'move_start', 'deadline',
+              'view_x_size', 'view_x_center')
+
+    def __init__(self):
+        self.__fish = [] # (FishState, deadline, priority)
+        self.__fish_pending = []
+        self.__positions = numpy.array([
+            [position for (position, _, _) in xy_locals_row]
+            for xy_locals_row in LakeState.xy_locals
+        ], dtype=numpy.int64)
+        self.__arrays = dict((field, numpy.zeros(0))
+                             for field in LakeEngine.fields)
+
+    def __len__(self):
+        return len(self.__fish) + len(self.__fish_pending)
+
+    def fish(self):
+        # all the resident fish as (FishState, deadline, priority)
+        return self.__fish + self.__fish_pending
+
+    def add(self, state, deadline, priority):
+        data = state.data()
+        now = default_timer()
+        if data['move_start'] is None or data['move_start'] > now:
+            data['move_count'] = 0
+            data['move_start'] = now
+        self.__fish_pending.append((state, deadline, priority))
+
+    def __add_pending(self):
+        if self.__fish_pending == []:
+            return
+        arrays_pending = dict((field, []) for field in LakeEngine.fields)
+        for state, deadline, _ in self.__fish_pending:
+            data = state.data()
+            for field in LakeEngine.fields:
+                if field == 'deadline':
+                    arrays_pending[field].append(deadline)
+                else:
+                    arrays_pending[field].append(data[field])
+        for field in LakeEngine.fields:
+            if field in ('move_start', 'deadline'):
+                dtype = numpy.float64
+            else:
+                dtype = numpy.int64
+            self.__arrays[field] = numpy.concatenate((
+                self.__arrays[field].astype(dtype),
+                numpy.array(arrays_pending[field], dtype=dtype),
+            ))
+        self.__fish.extend(self.__fish_pending)
+        self.__fish_pending = []
+
+    def timeout(self, now):
+        # milliseconds until the next fish move or death is due
+        self.__add_pending()
+        if self.__fish == []:
+            return Scheduler.timeout_max
+        a = self.__arrays
+        due = numpy.minimum(
+            a['move_start'] + (a['move_count'] + 1) * a['move_rate'] / 1000.0,
+            a['deadline'] - FishState.timeout_death / 1000.0,
+        ).min()
+        return min(max(0, int((due - now) * 1000) + 1),
+                   Scheduler.timeout_max)
+
+    def step(self, now):
+        # move all the fish that are due, returning the fish that depart
+        # as a list of (position, FishState, timeout, priority)
+        # pylint: disable=too-many-locals
+        self.__add_pending()
+        count_fish = len(self.__fish)
+        if count_fish == 0:
+            return []
+        a = self.__arrays
+        dead = a['deadline'] - FishState.timeout_death / 1000.0 <= now
+        count = (numpy.floor((now - a['move_start']) * 1000.0 /
+                             a['move_rate']).astype(numpy.int64) -
+                 a['move_count'])
+        count = numpy.where(dead, 0, numpy.maximum(count, 0))
+        if not dead.any() and not count.any():
+            return []
+        x_lake_old = a['x'].copy()
+        y_lake_old = a['y'].copy()
+        position = numpy.full(count_fish, LakeState.position,
+                              dtype=numpy.int64)
+        alive = numpy.ones(count_fish, dtype=bool)
+        steps = numpy.zeros(count_fish, dtype=numpy.int64)
+        active = count > 0
+        x_min = LakeState.x_boundary_min()
+        x_max = LakeState.x_boundary_max()
+        y_min = LakeState.y_boundary_min()
+        y_max = LakeState.y_boundary_max()
+        while True:
+            i = numpy.nonzero(active)[0]
+            if i.size == 0:
+                break
+            x_lake = a['x'][i]
+            y_lake = a['y'][i]
+            look_x_min = a['look_x_min'][i]
+            move_y_min = a['move_y_min'][i]
+            view_x_size = a['view_x_size'][i]
+            x_lake += numpy.where(look_x_min == 1, -1, 1)
+            move_y = numpy.random.random(i.size) < FishState.move_y_chance
+            y_lake += numpy.where(move_y,
+                                  numpy.where(move_y_min == 1, -1, 1), 0)
+            flip = (numpy.random.random(i.size) <
+                    FishState.move_x_flip_chance)
+            flip_min = flip & (look_x_min == 1) & (x_lake < x_min)
+            flip_max = (flip & (look_x_min == 0) &
+                        (x_lake - (view_x_size - 1) > x_max))
+            x_lake += flip_min.astype(numpy.int64) - flip_max
+            look_x_min = numpy.where(flip_min | flip_max,
+                                     1 - look_x_min, look_x_min)
+            bounce_min = y_lake < y_min
+            bounce_max = y_lake > y_max
+            y_lake += bounce_min.astype(numpy.int64) - bounce_max
+            move_y_min = numpy.where(bounce_min | bounce_max,
+                                     1 - move_y_min, move_y_min)
+            a['x'][i] = x_lake
+            a['y'][i] = y_lake
+            a['look_x_min'][i] = look_x_min
+            a['move_y_min'][i] = move_y_min
+            steps[i] += 1
+            alive_i = (x_lake >= x_min) & (x_lake - (view_x_size - 1) <= x_max)
+            position_i = self.__positions[
+                y_lake, numpy.clip(x_lake - a['view_x_center'][i],
+                                   x_min, x_max)
+            ]
+            alive[i] = alive_i
+            position[i] = position_i
+            active[i] = (alive_i & (position_i == LakeState.position) &
+                         (steps[i] < count[i]))
+        a['move_count'] += steps
+        Stats.local().count('moves', int(steps.sum()))
+        departed = alive & ~dead & (position != LakeState.position)
+        remove = dead | ~alive | departed
+        departures = []
+        for i in numpy.nonzero((steps > 0) | remove)[0]:
+            (state, deadline, priority) = self.__fish[i]
+            if steps[i] > 0:
+                data = state.data()
+                look_x_min = int(a['look_x_min'][i])
+                if look_x_min != data['look_x_min']:
+                    data['look_x_min'] = look_x_min
+                    data['view'] = FishState.fish(data['position_hatched'],
+                                                  data['type_id'],
+                                                  look_x_min)
+                data['x'] = int(a['x'][i])
+                data['y'] = int(a['y'][i])
+                data['move_y_min'] = int(a['move_y_min'][i])
+                data['move_count'] = int(a['move_count'][i])
+                state.render(int(x_lake_old[i]), int(y_lake_old[i]))
+            if dead[i] or not alive[i]:
+                state.render_dead()
+            elif departed[i]:
+                departures.append((int(position[i]), state,
+                                   int((deadline - now) * 1000), priority))
+        if remove.any():
+            keep = ~remove
+            for field in LakeEngine.fields:
+                a[field] = a[field][keep]
+            self.__fish = [fish for fish, fish_keep in zip(self.__fish, keep)
+                           if fish_keep]
+        return departures
+
+class SchoolState(object):
+    # many fish within a single service request
+    encoding_version = 130 # distinct from the FishState encoding_version
+    encoding_version_v1 = 129 # older nodes (FishState version 1)
+    # binary wire format (little-endian):
+    #  version, fish count, service request timeout,
+    #  followed by (fish timeout, FishState binary) for each fish
+    encoding = struct.Struct(b'<BHI')
+    encoding_fish = struct.Struct(b'<I')
+
+    @staticmethod
+    def school(data):
+        return data[0:1] in (
+            struct.pack(b'<B', SchoolState.encoding_version),
+            struct.pack(b'<B', SchoolState.encoding_version_v1),
+        )
+
+    @staticmethod
+    def encode(fish):
+        # fish is a list of (FishState, timeout)
+        timeout = max(fish_timeout for _, fish_timeout in fish)
+        data = [SchoolState.encoding.pack(SchoolState.encoding_version,
+                                          len(fish), timeout)]
+        for state, fish_timeout in fish:
+            data.append(SchoolState.encoding_fish.pack(fish_timeout))
+            data.append(state.encode(binary=True))
+        return (b''.join(data), timeout)
+
+    @staticmethod
+    def decode(data, timeout):
+        # the service request timeout decrement is the time spent in transit
+        (version,
+         count, timeout_sent) = SchoolState.encoding.unpack_from(data)
+        if version == SchoolState.encoding_version_v1:
+            fish_size = FishState.encoding_v1.size
+        else:
+            assert version == SchoolState.encoding_version
+            fish_size = FishState.encoding.size
+        transit = max(0, timeout_sent - timeout)
+        fish = []
+        i = SchoolState.encoding.size
+        for _ in range(count):
+            (fish_timeout,) = SchoolState.encoding_fish.unpack_from(data, i)
+            i += SchoolState.encoding_fish.size
+            fish.append((FishState(data[i:i + fish_size], transit),
+                         fish_timeout - transit))
+            i += fish_size
+        return fish
+
+class FishCache(object):
+    # live fish handed to a lake thread of the same OS process,
+    # with only a token in the service request
+    # (used when the node is a single OS process and tracing is disabled,
+    #  so the service request is always received by this process)
+    enabled = True
+    encoding_version = 131 # distinct from the FishState encoding_version
+    # binary wire format (little-endian):
+    #  version, token
+    encoding = struct.Struct(b'<BQ')
+    tokens = itertools.count(1)
+    lock = threading.Lock()
+    fish = {} # token -> [(FishState, deadline)]
+    expiry = [] # (service request deadline, token)
+
+    @staticmethod
+    def usable(api):
+        return (FishCache.enabled and api.process_count() == 1 and
+                not Trace.path and not FishState.encoding_json)
+
+    @staticmethod
+    def token(data):
+        return data[0:1] == struct.pack(b'<B', FishCache.encoding_version)
+
+    @staticmethod
+    def put(fish):
+        # fish is a list of (FishState, timeout),
+        # returning the (service request, timeout)
+        now = default_timer()
+        timeout = max(fish_timeout for _, fish_timeout in fish)
+        token = next(FishCache.tokens)
+        with FishCache.lock:
+            # the service request timed out if the fish are still cached
+            while FishCache.expiry != [] and FishCache.expiry[0][0] <= now:
+                (_, token_expired) = heapq.heappop(FishCache.expiry)
+                if FishCache.fish.pop(token_expired, None) is not None:
+                    Stats.local().count('fish_cache_expired')
+            FishCache.fish[token] = [
+                (state, now + fish_timeout / 1000.0)
+                for state, fish_timeout in fish
+            ]
+            heapq.heappush(FishCache.expiry, (now + timeout / 1000.0, token))
+        return (FishCache.encoding.pack(FishCache.encoding_version, token),
+                timeout)
+
+    @staticmethod
+    def take(data):
+        # [(FishState, deadline)] or None if the token is unknown
+        (version, token) = FishCache.encoding.unpack(data)
+        assert version == FishCache.encoding_version
+        with FishCache.lock:
+            return FishCache.fish.pop(token, None)
+
 class HatcheryState(object):
     # pylint: disable=too-few-public-methods
 
     hatch_rate = 45 # seconds (frequency of fish births)
     hatch_lifespan_min = 120 # seconds (minimum timeout)
     hatch_lifespan_max = 240 # seconds (maximum timeout)
+    hatch_school = 1 # fish per birth (> 1 is a school of fish in 1 request)
+    hatch_density = 0 # fish resident in the node that stops hatching
+                      # (0 disables the population control)
+    hatch_lag_max = 100 # milliseconds of lake lag that stops hatching
+                        # (when hatch_density > 0)
+    hatch_catch_up = 2.0 # hatches that are late are spread out,
+                         # at most this many times the hatch_rate frequency
 
-    def __init__(self, data_json=None):
-        if data_json is not None:
-            # older hatchery data
-            data_json = json.loads(data_json)
-        else:
-            # a hatchery is started
-            data_json = {
-                'hatchery': {
-                    'hatch_start': default_timer(),
-                    'hatch_count': 0,
-                },
-            }
-        self.__data = data_json['hatchery']
+    def __init__(self, hatch_count=0, hatch_elapsed=0.0):
+        # a hatchery is started
+        # (or restarted, with the hatch_count and seconds since hatch_start
+        #  from the restart() of an earlier process)
+        self.__data = {
+            'hatch_start': default_timer() - hatch_elapsed,
+            'hatch_count': hatch_count,
+        }
 
-    def __str__(self):
-        return json.dumps({'hatchery': self.__data})
+    def restart(self):
+        # (hatch_count, seconds since hatch_start) for a later process
+        return (self.__data['hatch_count'],
+                default_timer() - self.__data['hatch_start'])
 
     def tick(self, api):
-        # hatch new fish (1 fish is 1 CloudI service request)
+        # hatch new fish (1 fish or 1 school of fish
+        #                 is 1 CloudI service request),
+        # returning when the next hatch is due (default_timer() seconds)
         now = default_timer()
-        hatch_elapsed = int(now - self.__data['hatch_start'])
+        hatch_elapsed = now - self.__data['hatch_start']
+        count = 0
+        late = 0
         if hatch_elapsed < 0:
             self.__data['hatch_count'] = 0
             self.__data['hatch_start'] = now
-            count = 0
         else:
             hatch_count = self.__data['hatch_count']
-            count = (hatch_elapsed // HatcheryState.hatch_rate) - hatch_count
-            if count > 0:
-                self.__data['hatch_count'] = hatch_count + count
-            else:
-                count = 0
+            due = (int(hatch_elapsed // HatcheryState.hatch_rate) -
+                   hatch_count)
+            if due > 0:
+                if HatcheryState.__backpressure(api):
+                    # skip the hatches that are due
+                    self.__data['hatch_count'] = hatch_count + due
+                else:
+                    count = 1
+                    late = due - 1
+                    self.__data['hatch_count'] = hatch_count + 1
         for _ in range(count):
-            api.send_async(
-                api.prefix() + 'lake',
-                str(FishState()).encode('utf-8'),
-                timeout=HatcheryState.__fish_timeout(),
-            )
-        elapsed = default_timer() - now
-        if elapsed < 1.0:
-            time.sleep(1.0 - elapsed)
+            if FishCache.usable(api):
+                (request, timeout) = FishCache.put([
+                    (FishState(), HatcheryState.__fish_timeout())
+                    for _ in range(HatcheryState.hatch_school)
+                ])
+                api.send_async(
+                    api.prefix() + 'lake',
+                    request,
+                    timeout=timeout,
+                )
+            elif (HatcheryState.hatch_school > 1 and
+                  not FishState.encoding_json):
+                (request, timeout) = SchoolState.encode([
+                    (FishState(), HatcheryState.__fish_timeout())
+                    for _ in range(HatcheryState.hatch_school)
+                ])
+                api.send_async(
+                    api.prefix() + 'lake',
+                    request,
+                    timeout=timeout,
+                )
+            else:
+                for _ in range(HatcheryState.hatch_school):
+                    api.send_async(
+                        api.prefix() + 'lake',
+                        FishState().encode(),
+                        timeout=HatcheryState.__fish_timeout(),
+                    )
+        stats = Stats.local()
+        stats.count('fish_hatched', count * HatcheryState.hatch_school)
+        if late > 0:
+            return now + (HatcheryState.hatch_rate /
+                          HatcheryState.hatch_catch_up)
+        return (self.__data['hatch_start'] +
+                (self.__data['hatch_count'] + 1) * HatcheryState.hatch_rate)
+
+    @staticmethod
+    def __backpressure(api):
+        # is the node at its fish density or are the lake threads
+        # falling behind the fish moves that are due
+        if HatcheryState.hatch_density <= 0:
+            return False
+        if FrameBuffer.buffer is not None:
+            # the threads of every process (with the only hatchery)
+            gauges = FrameBuffer.gauges()
+            fish = sum(fish_resident for (fish_resident, _) in gauges)
+            lag = max([lake_lag for (_, lake_lag) in gauges] + [0])
+        else:
+            # the threads of this process, with a hatchery in each process
+            # (assuming the processes have a similar number of fish)
+            fish = (sum(Stats.gauges_all('fish_resident')) *
+                    api.process_count())
+            lag = max(Stats.gauges_all('lake_lag') + [0])
+        if fish >= HatcheryState.hatch_density:
+            Log.debug('hatchery', 'skip hatching (%d fish)', fish)
+            return True
+        if lag > HatcheryState.hatch_lag_max:
+            Log.debug('hatchery', 'skip hatching (%d ms lake lag)', lag)
+            return True
+        return False
 
     @staticmethod
     def __fish_timeout():
         return random.randint(HatcheryState.hatch_lifespan_min,
                               HatcheryState.hatch_lifespan_max) * 1000
 
+class Snapshot(object):
+    # the resident fish (and hatchery) of each thread, written periodically
+    # so a restarted node continues with the same lake population
+    path = '' # snapshot file path ({position}, {process} and {thread}
+              # are replaced), disabled if empty
+    interval = 10.0 # seconds between snapshots
+    age_max = 600.0 # seconds (older snapshots are not restored)
+    magic = b'FISHSNAP'
+    version = 1
+    # binary file format (little-endian):
+    #  magic, then a header of version, time (time.time() seconds),
+    #  hatch_count, seconds since hatch_start (NaN without a hatchery),
+    #  school count, followed by (size, SchoolState) for each school
+    #  (the SchoolState timeouts are relative to the snapshot time)
+    header = struct.Struct(b'<BdIdI')
+    school_size = struct.Struct(b'<I')
+    school_fish_max = 65535
+
+    @staticmethod
+    def file_path(process_index, thread_index):
+        if Snapshot.path == '':
+            return None
+        if '{process}' not in Snapshot.path or '{thread}' not in Snapshot.path:
+            # each thread needs a separate snapshot file
+            Log.error('snapshot', 'snapshot path %s without {process} and '
+                      '{thread} ignored', Snapshot.path)
+            return None
+        return Snapshot.path.format(position=LakeState.position,
+                                    process=process_index,
+                                    thread=thread_index)
+
+    @staticmethod
+    def write(path, fish, hatchery):
+        # fish is a list of (FishState, timeout), hatchery may be None
+        if hatchery is None:
+            (hatch_count, hatch_elapsed) = (0, float('nan'))
+        else:
+            (hatch_count, hatch_elapsed) = hatchery.restart()
+        schools = []
+        for i in range(0, len(fish), Snapshot.school_fish_max):
+            (school, _) = SchoolState.encode(
+                fish[i:i + Snapshot.school_fish_max]
+            )
+            schools.append(Snapshot.school_size.pack(len(school)) + school)
+        data = Snapshot.magic + Snapshot.header.pack(
+            Snapshot.version, time.time(),
+            hatch_count, hatch_elapsed, len(schools),
+        ) + b''.join(schools)
+        # replace the previous snapshot atomically
+        # (with a temporary file unique to the writer)
+        path_tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(path_tmp, 'wb') as snapshot_file:
+                snapshot_file.write(data)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.rename(path_tmp, path)
+        except (IOError, OSError) as e:
+            Log.error('snapshot', 'snapshot %s failed: %s', path, str(e))
+
+    @staticmethod
+    def read(path):
+        # (fish list of (FishState, timeout), HatcheryState or None)
+        # or None if there is no recent snapshot
+        try:
+            snapshot_file = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        with snapshot_file:
+            size = os.fstat(snapshot_file.fileno()).st_size
+            if size < len(Snapshot.magic) + Snapshot.header.size:
+                return None
+            data = mmap.mmap(snapshot_file.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+            try:
+                return Snapshot.__decode(data)
+            except (struct.error, AssertionError, ValueError) as e:
+                # not a snapshot written by this version
+                Log.error('snapshot', 'snapshot %s invalid: %s',
+                          path, repr(e))
+                return None
+            finally:
+                data.close()
+
+    @staticmethod
+    def __decode(data):
+        if data[0:len(Snapshot.magic)] != Snapshot.magic:
+            return None
+        i = len(Snapshot.magic)
+        (version, snapshot_time, hatch_count, hatch_elapsed,
+         schools) = Snapshot.header.unpack_from(data, i)
+        if version != Snapshot.version:
+            return None
+        i += Snapshot.header.size
+        age = time.time() - snapshot_time
+        if age < 0 or age > Snapshot.age_max:
+            return None
+        age_ms = int(age * 1000)
+        fish = []
+        for _ in range(schools):
+            (size,) = Snapshot.school_size.unpack_from(data, i)
+            i += Snapshot.school_size.size
+            school = data[i:i + size]
+            i += size
+            # the time since the snapshot is decoded like time in transit
+            (_, _, timeout_sent) = SchoolState.encoding.unpack_from(school)
+            for state, timeout in SchoolState.decode(
+                school, max(0, timeout_sent - age_ms)
+            ):
+                if timeout > FishState.timeout_death:
+                    fish.append((state, timeout))
+        if hatch_elapsed != hatch_elapsed: # NaN
+            hatchery = None
+        else:
+            hatchery = HatcheryState(hatch_count, hatch_elapsed + age)
+        return (fish, hatchery)
+
 class Task(threading.Thread):
+    # thread roles are computed from count_thread and count_process:
+    #  'control' (thread 0) has the log/stats services,
+    #  'view' (thread 0 of process 0, or of every process if the
+    #          FrameBuffer is not enabled) has the view/hatchery timers,
+    #  'lake' (all the other threads) has the lake service
+    #  with a view thread also a lake thread if
+    #  count_thread < control_dedicated_threads
+    control_dedicated_threads = 16
+    control_lag_max = 250 # milliseconds of timer lag caused by the lake
+                          # before a view thread stops serving the lake
+                          # (0 disables the check)
+    migration_window = 10 # milliseconds fish wait for other fish
+                          # leaving for the same remote position
+    migration_size = 32 # fish that leave without waiting for the window
+
     def __init__(self, thread_index):
         threading.Thread.__init__(self)
         self.__api = None
         self.__thread_index = thread_index
+        self.__roles = None
+        self.__scheduler = Scheduler()
+        self.__timers = Scheduler()
+        self.__hatchery = None
+        self.__engine = None
+        self.__departures = {}
+        self.__snapshot_path = None
 
     def run(self):
         # pylint: disable=bare-except
         try:
-            self.__api = API(self.__thread_index)
-            LakeState.set_position(self.__api.prefix())
-            if self.__thread_index == 0:
+            Log.setup()
+            api = API(self.__thread_index)
+            LakeState.set_position(api.prefix())
+            process_index = api.process_index()
+            Trace.start(LakeState.position, process_index,
+                        api.process_count())
+            self.__api = Trace.api(api)
+            FishState.atlas_create()
+            if LakeEngine.enabled and numpy is not None:
+                self.__engine = LakeEngine()
+            if FrameBuffer.enabled and shared_memory is not None:
+                FrameBuffer.open(process_index, api.process_count(),
+                                 API.thread_count())
+            self.__roles = Task.roles(self.__thread_index,
+                                      API.thread_count(), process_index)
+            self.__snapshot_path = Snapshot.file_path(process_index,
+                                                      self.__thread_index)
+            restored = None
+            if self.__snapshot_path is not None:
+                restored = Snapshot.read(self.__snapshot_path)
+            if 'control' in self.__roles:
+                self.__api.subscribe('log', self.__log)
+                self.__api.subscribe('stats', self.__stats)
+            if 'view' in self.__roles:
                 self.__api.send_async(
                     self.__api.prefix() + 'display',
                     b'\xff\0\0' +
-                    b'                ' +
-                    b'                '
+                    b' ' * (LakeState.columns * LakeState.rows)
                 )
-            if self.__thread_index == 1 or self.__thread_index == 2:
-                self.__api.subscribe('view', self.__view)
-            elif self.__thread_index == 3 or self.__thread_index == 4:
-                self.__api.subscribe('hatchery', self.__hatchery)
-            else:
+                # periodic work is done with timers between service requests
+                # so no thread is blocked waiting for it
+                if restored is not None and restored[1] is not None:
+                    self.__hatchery = restored[1]
+                else:
+                    self.__hatchery = HatcheryState()
+                now = default_timer()
+                self.__timer(now, self.__view)
+                self.__timer(now, self.__hatch)
+            if 'lake' in self.__roles:
                 self.__api.subscribe('lake', self.__lake)
-            if self.__thread_index == 0:
-                self.__api.send_async(
-                    self.__api.prefix() + 'view', b'',
-                )
-                self.__api.send_async(
-                    self.__api.prefix() + 'hatchery',
-                    str(HatcheryState()).encode('utf-8'),
-                )
+            if restored is not None:
+                self.__restore(restored[0])
+            if self.__snapshot_path is not None:
+                self.__timer(default_timer() + Snapshot.interval,
+                             self.__snapshot)
+            Log.info('roles', 'process %d thread %d roles %s',
+                     process_index, self.__thread_index,
+                     ','.join(self.__roles))
 
-            result = self.__api.poll()
+            # resident fish move when they are due,
+            # with incoming service requests handled while waiting
+            stats = Stats.local()
+            gauge_index = (process_index * API.thread_count() +
+                           self.__thread_index)
+            result = True
+            while result is True:
+                if self.__engine is not None:
+                    self.__engine_step()
+                    timeout = self.__engine.timeout(default_timer())
+                    fish_resident = len(self.__engine)
+                else:
+                    for (state, deadline, priority) in self.__scheduler.due(
+                        default_timer()
+                    ):
+                        self.__fish(state, deadline, priority)
+                    timeout = self.__scheduler.timeout(default_timer())
+                    fish_resident = len(self.__scheduler)
+                stats.gauge('fish_resident', fish_resident)
+                self.__timers_run()
+                timeout = min(timeout, self.__timers.timeout(default_timer()),
+                              self.__depart())
+                poll_start = default_timer()
+                result = self.__api.poll(timeout)
+                # time spent handling service requests beyond the timeout
+                # delays the fish moves that are due
+                lake_lag = max(0, int(
+                    (default_timer() - poll_start) * 1000
+                ) - timeout)
+                stats.gauge('lake_lag', lake_lag)
+                if FrameBuffer.buffer is not None:
+                    FrameBuffer.gauges_set(gauge_index,
+                                           fish_resident, lake_lag)
             assert result is False
         except TerminateException:
             pass
         except:
             traceback.print_exc(file=sys.stderr)
-        print('terminate fish')
+        if self.__snapshot_path is not None:
+            self.__snapshot_write()
+        Log.info('terminate', 'terminate fish')
+
+    @staticmethod
+    def roles(thread_index, thread_count, process_index=0):
+        # the roles of a thread
+        if thread_index != 0:
+            return ('lake',)
+        if process_index != 0 and FrameBuffer.buffer is not None:
+            return ('control', 'lake')
+        if (thread_count == 1 or
+            thread_count < Task.control_dedicated_threads):
+            return ('control', 'view', 'lake')
+        return ('control', 'view')
+
+    def __timer(self, due, function):
+        self.__timers.add(due, (due, function))
 
-    def __hatchery(self, _command, _name, _pattern, _request_info, request,
-                   _timeout, _priority, _trans_id, _pid):
+    def __timers_run(self):
+        now = default_timer()
+        for (due, function) in self.__timers.due(now):
+            lag = int((now - due) * 1000)
+            if (lag > Task.control_lag_max > 0 and 'view' in self.__roles and
+                'lake' in self.__roles and API.thread_count() > 1):
+                # the lake service requests delay the timers,
+                # so the other threads get all the new fish
+                # (the fish resident in this thread remain until they leave)
+                self.__api.unsubscribe('lake')
+                self.__roles = tuple(role for role in self.__roles
+                                     if role != 'lake')
+                Log.warn('roles', 'thread %d roles %s (timer lag %d ms)',
+                         self.__thread_index, ','.join(self.__roles), lag)
+            function()
+
+    def __snapshot(self):
+        self.__snapshot_write()
+        self.__timer(default_timer() + Snapshot.interval, self.__snapshot)
+
+    def __snapshot_write(self):
+        now = default_timer()
+        if self.__engine is not None:
+            resident = self.__engine.fish()
+        else:
+            resident = self.__scheduler.events()
+        fish = []
+        for (state, deadline, _) in resident:
+            timeout = int((deadline - now) * 1000)
+            if timeout > FishState.timeout_death:
+                fish.append((state, timeout))
+        Snapshot.write(self.__snapshot_path, fish, self.__hatchery)
+        Stats.local().latency('snapshot', now)
+
+    def __restore(self, fish):
+        # the fish of the previous process are sent to the lake again
+        # (so the current lake threads share them)
+        for i in range(0, len(fish), Task.migration_size):
+            (request, timeout) = SchoolState.encode(
+                fish[i:i + Task.migration_size]
+            )
+            self.__api.send_async(
+                self.__api.prefix() + 'lake',
+                request,
+                timeout=timeout,
+            )
+        Log.info('snapshot', 'restored %d fish from %s',
+                 len(fish), self.__snapshot_path)
+
+    def __hatch(self):
+        start = default_timer()
+        self.__timer(self.__hatchery.tick(self.__api), self.__hatch)
+        Stats.local().latency('hatchery', start)
+
+    def __log(self, _command, _name, _pattern, _request_info, request,
+              _timeout, _priority, _trans_id, _pid):
         # pylint: disable=too-many-arguments
-        state = HatcheryState(request.decode('utf-8'))
-        state.tick(self.__api)
-        self.__api.send_async(
-            self.__api.prefix() + 'hatchery',
-            str(state).encode('utf-8'),
-        )
+        # pylint: disable=no-self-use
+        return Log.configure(request)
 
-    def __view(self, _command, _name, _pattern, _request_info, _request,
-               _timeout, _priority, _trans_id, _pid):
+    def __stats(self, _command, _name, _pattern, _request_info, _request,
+                _timeout, _priority, _trans_id, _pid):
         # pylint: disable=too-many-arguments
-        LakeState.tick(self.__api)
-        self.__api.send_async(
-            self.__api.prefix() + 'view', b'',
-        )
+        # pylint: disable=no-self-use
+        return Stats.snapshot()
 
-    def __lake(self, command, _name, _pattern, request_info, request,
-               timeout, priority, trans_id, pid):
+    def __view(self):
+        start = default_timer()
+        dirty = LakeState.dirty or FrameBuffer.dirty()
+        self.__timer(LakeState.tick(self.__api), self.__view)
+        if dirty:
+            Stats.local().latency('view', start)
+
+    def __lake(self, _command, _name, _pattern, _request_info, request,
+               timeout, priority, _trans_id, _pid):
         # pylint: disable=too-many-arguments
-        state = FishState(request.decode('utf-8'))
+
+        # the fish resides in this thread until it leaves the node or dies,
+        # so the service request is complete once the fish is stored
+        now = default_timer()
+        if FishCache.token(request):
+            fish = FishCache.take(request)
+            if fish is None:
+                Log.warn('cache', 'fish cache miss')
+            else:
+                for state, deadline in fish:
+                    self.__fish(state, deadline, priority)
+        elif SchoolState.school(request):
+            for state, fish_timeout in SchoolState.decode(request, timeout):
+                self.__fish(state, now + fish_timeout / 1000.0, priority)
+        else:
+            self.__fish(FishState(request), now + timeout / 1000.0, priority)
+        self.__depart()
+        Stats.local().latency('lake', now)
+
+    def __fish(self, state, deadline, priority):
+        if self.__engine is not None:
+            self.__engine.add(state, deadline, priority)
+            return
+        now = default_timer()
+        timeout = int((deadline - now) * 1000)
         position = state.tick(timeout)
         if position is None:
             return
-        self.__api.forward_(
-            command, LakeState.prefix(position) + 'lake', request_info,
-            str(state).encode('utf-8'), timeout, priority, trans_id, pid,
-        )
+        if position == LakeState.position:
+            death = deadline - FishState.timeout_death / 1000.0
+            self.__scheduler.add(min(state.move_next(), death),
+                                 (state, deadline, priority))
+            Stats.local().count('fish_local')
+        else:
+            self.__departure(position, state, timeout, priority)
+
+    def __engine_step(self):
+        for (position, state, timeout, priority) in self.__engine.step(
+            default_timer()
+        ):
+            self.__departure(position, state, timeout, priority)
+
+    def __departure(self, position, state, timeout, priority):
+        now = default_timer()
+        key = (position, priority)
+        departures = self.__departures.get(key)
+        if departures is None:
+            departures = (now + Task.migration_window / 1000.0, [])
+            self.__departures[key] = departures
+        departures[1].append((state, now + timeout / 1000.0))
+
+    def __depart(self):
+        # fish leaving for the same remote position travel as a school
+        # (even a school of 1 fish, for the time spent in transit),
+        # once the migration window ends or the school is large enough,
+        # returning the milliseconds until the next school leaves
+        if self.__departures == {}:
+            return Scheduler.timeout_max
+        now = default_timer()
+        timeout_next = Scheduler.timeout_max
+        schools = []
+        for key, (due, fish) in self.__departures.items():
+            if due <= now or len(fish) >= Task.migration_size:
+                schools.append(key)
+            else:
+                timeout_next = min(timeout_next, int((due - now) * 1000) + 1)
+        stats = Stats.local()
+        for (position, priority) in schools:
+            (_, departures) = self.__departures.pop((position, priority))
+            # the wait for the migration window is part of the fish lifetime
+            fish = []
+            for state, deadline in departures:
+                timeout = int((deadline - now) * 1000)
+                if timeout > 0:
+                    fish.append((state, timeout))
+            name = LakeState.prefix(position) + 'lake'
+            if FishState.encoding_json:
+                for state, timeout in fish:
+                    self.__api.send_async(
+                        name, state.encode(),
+                        timeout=timeout, priority=priority,
+                    )
+                stats.count('requests_remote', len(fish))
+            else:
+                for i in range(0, len(fish), Task.migration_size):
+                    (request, timeout) = SchoolState.encode(
+                        fish[i:i + Task.migration_size]
+                    )
+                    self.__api.send_async(
+                        name, request,
+                        timeout=timeout, priority=priority,
+                    )
+                    stats.count('requests_remote')
+            stats.count('fish_remote', len(fish))
+        return timeout_next
 
 if __name__ == '__main__':
+    Configuration.setup([LakeState, FishState, HatcheryState,
+                         LakeEngine, Scheduler, Log, Trace, Task,
+                         FrameEncoding, FrameBuffer, FishCache, Snapshot])
     thread_count = API.thread_count()
     assert thread_count >= 1
 
@@ -549,3 +2235,6 @@ if __name__ == '__main__':
         t.start()
     for t in threads:
         t.join()
+    FrameBuffer.close()
+    Trace.flush()
+    Log.flush()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#-*-Mode:python;coding:utf-8;tab-width:4;c-basic-offset:4;indent-tabs-mode:()-*-
+# ex: set ft=python fenc=utf-8 sts=4 ts=4 sw=4 et:
+#
+# MIT License
+#
+# Copyright (c) 2023 Michael Truog <mjtruog at protonmail dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+# fish.py benchmarks with the fish_simulator.py stand-in CloudI API
+# at increasing fish populations and thread counts
+# (all node positions share a single process, so results are only
+#  comparable with other results from the same machine)
+
+import argparse
+import json
+import threading
+from fish_simulator import Lake
+
+class Measurement(object):
+    # metrics of all the node positions during a measurement window
+    handlers = ('lake', 'view', 'hatchery')
+
+    def __init__(self, lake):
+        self.__lake = lake
+        self.__router = dict(lake.router.counters)
+        self.__stats = lake.stats()
+
+    @staticmethod
+    def __histograms(stats, name):
+        count = 0
+        total = 0.0
+        for position_stats in stats:
+            histogram = position_stats['histograms'].get(name)
+            if histogram is not None:
+                count += histogram['count']
+                total += histogram['count'] * histogram['mean_ms']
+        return (count, total)
+
+    @staticmethod
+    def __counter(stats, name):
+        return sum(position_stats['counters'].get(name, 0)
+                   for position_stats in stats)
+
+    def result(self, elapsed):
+        router = dict(self.__lake.router.counters)
+        stats = self.__lake.stats()
+        def router_delta(name):
+            return router.get(name, 0) - self.__router.get(name, 0)
+        def counter_delta(name):
+            return (Measurement.__counter(stats, name) -
+                    Measurement.__counter(self.__stats, name))
+        view_ticks = counter_delta('view_ticks')
+        result = {
+            'moves_per_second': counter_delta('moves') / elapsed,
+            'lake_requests_per_second': router_delta('requests/lake') / elapsed,
+            'remote_fish_per_second': counter_delta('fish_remote') / elapsed,
+            'display_merge_bytes_per_tick': (
+                router_delta('bytes/display/merge') / float(view_ticks)
+                if view_ticks > 0 else 0.0
+            ),
+            'fish_resident': sum(position_stats['gauges'].get(
+                'fish_resident', 0
+            ) for position_stats in stats),
+        }
+        for name in Measurement.handlers:
+            (count, total) = Measurement.__histograms(stats, name)
+            (count_old, total_old) = Measurement.__histograms(self.__stats,
+                                                              name)
+            count -= count_old
+            total -= total_old
+            result[name + '_latency_ms'] = total / count if count > 0 else 0.0
+        return result
+
+def benchmark(fish, thread_count, args):
+    settings = {
+        'Log.level': 'warn',
+        # only the fish added by the benchmark
+        'HatcheryState.hatch_rate': 1000000,
+    }
+    if args.engine:
+        settings['LakeEngine.enabled'] = True
+    for setting in args.set:
+        (name, value) = setting.split('=', 1)
+        settings[name] = json.loads(value)
+    lake = Lake(thread_count=thread_count, latency_remote=args.latency,
+                settings=settings, process_count=args.processes)
+    lake.start()
+    lake.populate(fish, args.warmup + args.duration + 60.0)
+    threading.Event().wait(args.warmup)
+    measurement = Measurement(lake)
+    threading.Event().wait(args.duration)
+    result = measurement.result(args.duration)
+    lake.stop()
+    result['fish'] = fish
+    result['threads'] = thread_count
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fish.py')
+    parser.add_argument('--fish', type=int, nargs='+',
+                        default=[10, 100, 1000],
+                        help='fish added to each node position')
+    parser.add_argument('--threads', type=int, nargs='+', default=[8, 16],
+                        help='CloudI count_thread of each node')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='CloudI count_process of each node')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=3.0,
+                        help='seconds before the measurement')
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help='milliseconds between node positions')
+    parser.add_argument('--engine', action='store_true',
+                        help='use the numpy LakeEngine')
+    parser.add_argument('--json', action='store_true',
+                        help='output JSON')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='Class.attribute=value',
+                        help='fish.py class attribute setting')
+    args = parser.parse_args()
+    columns = ('fish', 'threads', 'fish_resident',
+               'moves_per_second', 'lake_requests_per_second',
+               'remote_fish_per_second', 'display_merge_bytes_per_tick',
+               'lake_latency_ms', 'view_latency_ms', 'hatchery_latency_ms')
+    results = []
+    if not args.json:
+        print(' '.join(columns))
+    for thread_count in args.threads:
+        for fish in args.fish:
+            result = benchmark(fish, thread_count, args)
+            results.append(result)
+            if not args.json:
+                print(' '.join(
+                    ('%d' if isinstance(result[column], int) else '%.3f') %
+                    result[column]
+                    for column in columns
+                ))
+    if args.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#-*-Mode:python;coding:utf-8;tab-width:4;c-basic-offset:4;indent-tabs-mode:()-*-
+# ex: set ft=python fenc=utf-8 sts=4 ts=4 sw=4 et:
+#
+# MIT License
+#
+# Copyright (c) 2023 Michael Truog <mjtruog at protonmail dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+# Replay a fish.py trace file (created with ODROID_FISH_TRACE_PATH)
+# into the fish_simulator.py lake, at real-time or maximum speed,
+# using the random seed recorded in the trace
+
+import argparse
+import json
+import mmap
+import threading
+import collections
+import uuid
+from timeit import default_timer
+from fish_simulator import Lake
+
+class TraceFile(object):
+    # memory-mapped trace file, read one record at a time
+    def __init__(self, path, trace):
+        # trace is the fish.py Trace class (for the file format)
+        self.__trace = trace
+        self.__file = open(path, 'rb')
+        self.__mapped = mmap.mmap(self.__file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.__mapped.close()
+        self.__file.close()
+
+    def segments(self):
+        # (offset, version, position, seed, start time) for each time
+        # tracing was started with the same file
+        trace = self.__trace
+        mapped = self.__mapped
+        segments = []
+        offset = 0
+        while offset < len(mapped):
+            assert mapped[offset:offset + len(trace.magic)] == trace.magic
+            offset += len(trace.magic)
+            (version, position, seed,
+             start_time) = trace.header.unpack_from(mapped, offset)
+            assert version == trace.version
+            offset += trace.header.size
+            segments.append((offset, version, position, seed, start_time))
+            while True:
+                record = self.__record(offset)
+                if record is None:
+                    break
+                offset = record[0]
+        return segments
+
+    def records(self, offset):
+        # (kind, elapsed, timeout, priority, name, request) of a segment
+        while True:
+            record = self.__record(offset)
+            if record is None:
+                return
+            offset = record[0]
+            yield record[1:]
+
+    def __record(self, offset):
+        # (next offset, kind, elapsed, timeout, priority, name, request)
+        # or None at the end of a segment
+        trace = self.__trace
+        mapped = self.__mapped
+        if (offset >= len(mapped) or
+            mapped[offset:offset + len(trace.magic)] == trace.magic):
+            return None
+        (kind, elapsed, timeout, priority,
+         name_size, request_size) = trace.record.unpack_from(mapped, offset)
+        offset += trace.record.size
+        name = mapped[offset:offset + name_size].decode('utf-8')
+        offset += name_size
+        request = mapped[offset:offset + request_size]
+        offset += request_size
+        return (offset, kind, elapsed, timeout, priority, name, request)
+
+def main():
+    # pylint: disable=too-many-locals
+    parser = argparse.ArgumentParser(description='Replay a fish.py trace')
+    parser.add_argument('path', help='trace file')
+    parser.add_argument('--segment', type=int, default=0,
+                        help='index of the traced run within the file')
+    parser.add_argument('--speed', choices=('realtime', 'max'),
+                        default='realtime')
+    parser.add_argument('--patterns', nargs='+', default=['lake'],
+                        help='service request patterns to replay')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='CloudI count_thread of each node')
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help='milliseconds between node positions')
+    parser.add_argument('--drain', type=float, default=5.0,
+                        help='seconds to run after the replay')
+    args = parser.parse_args()
+    # fish hatched by the traced node are in the trace
+    lake = Lake(thread_count=args.threads, latency_remote=args.latency,
+                settings={
+                    'Log.level': 'warn',
+                    'HatcheryState.hatch_rate': 1000000,
+                })
+    trace_file = TraceFile(args.path, lake.nodes[0].Trace)
+    (offset, _, position, seed,
+     start_time) = trace_file.segments()[args.segment]
+    for node in lake.nodes:
+        node.Trace.seed = seed
+    prefix = lake.nodes[position].LakeState.prefix(position)
+    patterns = set(prefix + pattern for pattern in args.patterns)
+    lake.start()
+    counts = collections.defaultdict(int)
+    start = default_timer()
+    for (kind, elapsed, timeout, priority,
+         name, request) in trace_file.records(offset):
+        if kind != lake.nodes[0].Trace.REQUEST or name not in patterns:
+            continue
+        if args.speed == 'realtime':
+            delay = start + elapsed - default_timer()
+            if delay > 0:
+                threading.Event().wait(delay)
+        lake.router.send(prefix, name, b'', request, timeout, priority,
+                         uuid.uuid1().bytes)
+        counts[name] += 1
+    elapsed_replay = default_timer() - start
+    threading.Event().wait(args.drain)
+    stats = lake.stats()
+    lake.stop()
+    trace_file.close()
+    print(json.dumps({
+        'trace': {
+            'position': position,
+            'seed': seed,
+            'start_time': start_time,
+        },
+        'replayed': counts,
+        'replay_seconds': elapsed_replay,
+        'router': lake.router.counters,
+        'positions': stats,
+    }, indent=4, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+#-*-Mode:python;coding:utf-8;tab-width:4;c-basic-offset:4;indent-tabs-mode:()-*-
+# ex: set ft=python fenc=utf-8 sts=4 ts=4 sw=4 et:
+#
+# MIT License
+#
+# Copyright (c) 2023 Michael Truog <mjtruog at protonmail dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+# Headless fish.py lake simulation without a CloudI installation.
+# A stand-in for the parts of the CloudI Python API used by fish.py routes
+# service requests in-process among the simulated node positions
+# (each node position is a separate copy of the fish.py module).
+
+import sys
+import os
+import threading
+import traceback
+import collections
+import importlib.util
+import argparse
+import json
+import uuid
+import struct
+from timeit import default_timer
+
+class TerminateException(Exception):
+    pass
+
+class ForwardAsyncException(Exception):
+    pass
+
+class Router(object):
+    # in-process service request routing with a configurable latency
+    # (the request timeout is decremented while the request is queued,
+    #  like the CloudI service configuration option
+    #  request_timeout_adjustment == true)
+    sinks = ('display', 'display/merge') # not provided by fish.py
+
+    def __init__(self, latency_local=0.0, latency_remote=0.0):
+        self.__condition = threading.Condition()
+        self.__queues = {}
+        self.__latency_local = latency_local / 1000.0
+        self.__latency_remote = latency_remote / 1000.0
+        self.__sink_functions = []
+        self.terminate = False
+        self.counters = collections.defaultdict(int)
+
+    def sink(self, function):
+        # function(name, pattern, request) is called for each sink request
+        self.__sink_functions.append(function)
+
+    @staticmethod
+    def pattern(name):
+        # '/odroid/fish/#/pattern' -> 'pattern'
+        return name.split('/', 4)[4]
+
+    def send(self, source, name, request_info, request,
+             timeout, priority, trans_id):
+        # pylint: disable=too-many-arguments
+        pattern = Router.pattern(name)
+        self.counters['requests/' + pattern] += 1
+        self.counters['bytes/' + pattern] += len(request)
+        if pattern in Router.sinks:
+            for function in self.__sink_functions:
+                function(name, pattern, request)
+            return
+        now = default_timer()
+        if name.startswith(source):
+            deliver = now + self.__latency_local
+        else:
+            deliver = now + self.__latency_remote
+        with self.__condition:
+            queue = self.__queues.get(name)
+            if queue is None:
+                queue = collections.deque()
+                self.__queues[name] = queue
+            queue.append((deliver, now, (name, request_info, request,
+                                         timeout, priority, trans_id,
+                                         source)))
+            self.__condition.notify_all()
+
+    def receive(self, names, timeout):
+        # a request for one of the names, None if the timeout (milliseconds)
+        # elapses or False if the router is terminated
+        if timeout is None or timeout < 0:
+            end = None
+        else:
+            end = default_timer() + timeout / 1000.0
+        with self.__condition:
+            while True:
+                if self.terminate:
+                    return False
+                now = default_timer()
+                wait = None
+                for name in names:
+                    queue = self.__queues.get(name)
+                    while queue:
+                        (deliver, sent, request) = queue[0]
+                        if deliver > now:
+                            if wait is None or deliver - now < wait:
+                                wait = deliver - now
+                            break
+                        queue.popleft()
+                        elapsed = int((now - sent) * 1000)
+                        (name_request, request_info, request_data,
+                         request_timeout, priority, trans_id,
+                         source) = request
+                        if elapsed >= request_timeout:
+                            self.counters['timeouts'] += 1
+                            continue
+                        return (name_request, request_info, request_data,
+                                request_timeout - elapsed, priority,
+                                trans_id, source)
+                if end is not None:
+                    if end <= now:
+                        return None
+                    if wait is None or end - now < wait:
+                        wait = end - now
+                self.__condition.wait(wait)
+
+    def stop(self):
+        with self.__condition:
+            self.terminate = True
+            self.__condition.notify_all()
+
+    def api(self, prefix, thread_count, process_index=0, process_count=1):
+        # the API class used by a single node position OS process
+        return type('API', (API,), {
+            'router': self,
+            'node_prefix': prefix,
+            'node_thread_count': thread_count,
+            'node_process_index': process_index,
+            'node_process_count': process_count,
+        })
+
+class API(object):
+    # stand-in for the CloudI Python API (cloudi.API)
+    # pylint: disable=too-many-instance-attributes
+    ASYNC = 1
+    SYNC = -1
+    router = None
+    node_prefix = None
+    node_thread_count = None
+    node_process_index = None
+    node_process_count = None
+    timeout_async_default = 5000 # milliseconds
+
+    def __init__(self, thread_index):
+        # pylint: disable=unused-argument
+        self.__functions = {}
+
+    @classmethod
+    def thread_count(cls):
+        return cls.node_thread_count
+
+    def process_index(self):
+        return self.node_process_index
+
+    def process_count(self):
+        return self.node_process_count
+
+    def prefix(self):
+        return self.node_prefix
+
+    def subscribe(self, pattern, function):
+        self.__functions[self.node_prefix + pattern] = function
+
+    def unsubscribe(self, pattern):
+        del self.__functions[self.node_prefix + pattern]
+
+    def send_async(self, name, request,
+                   timeout=None, request_info=None, priority=None):
+        # pylint: disable=too-many-arguments
+        if timeout is None:
+            timeout = API.timeout_async_default
+        if request_info is None:
+            request_info = b''
+        if priority is None:
+            priority = 0
+        trans_id = uuid.uuid1().bytes
+        self.router.send(self.node_prefix, name, request_info, request,
+                         timeout, priority, trans_id)
+        return trans_id
+
+    def forward_(self, request_type, name, request_info, request,
+                 timeout, priority, trans_id, source):
+        # pylint: disable=too-many-arguments
+        # pylint: disable=unused-argument
+        self.router.send(self.node_prefix, name, request_info, request,
+                         timeout, priority, trans_id)
+        raise ForwardAsyncException()
+
+    def poll(self, timeout=-1):
+        # handle service requests until the timeout (milliseconds) elapses
+        if timeout is None or timeout < 0:
+            end = None
+        else:
+            end = default_timer() + timeout / 1000.0
+        while True:
+            if end is None:
+                timeout_receive = -1
+            else:
+                timeout_receive = max(0, int((end - default_timer()) * 1000))
+            request = self.router.receive(self.__functions, timeout_receive)
+            if request is False:
+                return False
+            if request is None:
+                return True
+            (name, request_info, request_data,
+             timeout_request, priority, trans_id, source) = request
+            function = self.__functions[name]
+            try:
+                function(API.ASYNC, name, Router.pattern(name),
+                         request_info, request_data, timeout_request,
+                         priority, trans_id, source)
+            except ForwardAsyncException:
+                pass
+            except TerminateException:
+                return False
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc(file=sys.stderr)
+
+class Display(object):
+    # stand-in for the odroid_display display/merge service of each
+    # node position, decoding frames with the fish.py reference decoder
+    # and comparing each decoded frame with the frame that was encoded
+    def __init__(self, processes):
+        self.__nodes = [processes_position[0]
+                        for processes_position in processes]
+        self.__lock = threading.Lock()
+        self.__frames = [{} for _ in self.__nodes]
+        self.__encoded = threading.local()
+        lake_state = self.__nodes[0].LakeState
+        size = lake_state.columns * lake_state.rows
+        self.screens = [[u' '] * size for _ in self.__nodes]
+        self.counters = collections.defaultdict(int)
+        for processes_position in processes:
+            for node in processes_position:
+                self.__record(node)
+
+    def __record(self, node):
+        # keep the frame the view thread encodes, since the display/merge
+        # sink is called by the same thread within send_async
+        encode = node.FrameEncoding.encode
+        encoded = self.__encoded
+
+        def encode_recorded(position, frame, *args):
+            encoded.frame = list(frame)
+            return encode(position, frame, *args)
+        node.FrameEncoding.encode = staticmethod(encode_recorded)
+
+    def sink(self, name, pattern, request):
+        if pattern != 'display/merge':
+            return
+        position = int(name.split('/')[3])
+        node = self.__nodes[position]
+        with self.__lock:
+            if node.LakeState.frame_encoding == 'delta':
+                decoded = node.FrameEncoding.decode(request,
+                                                    self.__frames[position])
+                frame_encoded = getattr(self.__encoded, 'frame', None)
+                self.__encoded.frame = None
+                if decoded is None:
+                    self.counters['frames_undecoded'] += 1
+                    return
+                (_, _, frame) = decoded
+                if frame != frame_encoded:
+                    self.counters['frames_mismatched'] += 1
+                frame = [cell.decode('utf-8') for cell in frame]
+            else:
+                (size, _, _, _) = struct.unpack_from(b'<IBBB', request)
+                frame = list(request[7:size + 4].decode('utf-8'))
+            screen = self.screens[position]
+            assert len(frame) == len(screen)
+            for index, cell in enumerate(frame):
+                if cell != u'\0':
+                    screen[index] = cell
+            self.counters['frames'] += 1
+
+    @staticmethod
+    def check(node):
+        # FrameEncoding round-trip check of a fish.py module
+        # (raises AssertionError if a decoded frame differs from the frame)
+        encoding = node.FrameEncoding
+        frames_sent = encoding.frames_sent
+        position = node.LakeState.position
+        encoding.frames_sent = {}
+        node.LakeState.position = 1
+        try:
+            def round_trip(frame, frames, keyframe):
+                request = encoding.encode(0, frame, 1)
+                (_, flags, _, _, _) = encoding.encoding.unpack_from(request)
+                if keyframe is not None:
+                    assert bool(flags & encoding.keyframe) == keyframe
+                assert encoding.decode(request, frames) == (1, 1, frame)
+                return request
+
+            glyphs = [character.encode('utf-8')
+                      for character in u'<\u00b0\u2190\u03b8\U0001f41f']
+            blank = [b'\0'] * 600
+            frame = list(blank)
+            frame[300:305] = glyphs
+            frames = {}
+            # keyframe, then deltas
+            round_trip(frame, frames, True)
+            for i in range(1, encoding.keyframe_interval):
+                frame = list(frame)
+                frame[i] = glyphs[i % len(glyphs)]
+                request = round_trip(frame, frames, False)
+            # a delta without a previous frame is not decoded
+            assert encoding.decode(request, {}) is None
+            # forced keyframe after keyframe_interval frames
+            frame = list(frame)
+            frame[0] = glyphs[1]
+            round_trip(frame, frames, True)
+            # only keyframes without deltas
+            frame = list(frame)
+            frame[1] = glyphs[0]
+            request = encoding.encode(0, frame, 1, False)
+            assert encoding.decode(request, {}) == (1, 1, frame)
+            # runs longer than 255 cells (skipped and literal)
+            frame = list(blank)
+            frame[280:580] = [glyphs[(i % 4) + 1] for i in range(300)]
+            round_trip(frame, frames, None)
+            frame = list(frame)
+            frame[10:590] = [glyphs[i % 5] for i in range(580)]
+            round_trip(frame, frames, None)
+            frame = list(frame)
+            frame[599] = glyphs[4]
+            round_trip(frame, frames, False)
+        finally:
+            encoding.frames_sent = frames_sent
+            node.LakeState.position = position
+
+    def rows(self, position):
+        columns = self.__nodes[0].LakeState.columns
+        screen = self.screens[position]
+        return [u''.join(screen[i:i + columns])
+                for i in range(0, len(screen), columns)]
+
+class Lake(object):
+    # fish.py node positions running in a single process
+    # (with process_count copies of the fish.py module for each node position
+    #  to stand in for the CloudI count_process OS processes)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fish.py')
+
+    def __init__(self, thread_count=8, latency_local=0.0,
+                 latency_remote=0.0, settings=None, process_count=1):
+        # pylint: disable=too-many-arguments
+        self.router = Router(latency_local=latency_local,
+                             latency_remote=latency_remote)
+        self.nodes = [] # process 0 of each node position
+        self.processes = [] # all the processes of each node position
+        self.__threads = []
+        cloudi = sys.modules.get('cloudi')
+        sys.modules['cloudi'] = sys.modules[__name__]
+        try:
+            position = 0
+            nodes_count = 1
+            while position < nodes_count:
+                processes = []
+                for process_index in range(process_count):
+                    node = Lake.__load(position, process_index)
+                    Lake.__setup(node, settings)
+                    processes.append(node)
+                nodes_count = (processes[0].LakeState.nodes_x *
+                               processes[0].LakeState.nodes_y)
+                self.nodes.append(processes[0])
+                self.processes.append(processes)
+                position += 1
+        finally:
+            if cloudi is None:
+                del sys.modules['cloudi']
+            else:
+                sys.modules['cloudi'] = cloudi
+        for position, processes in enumerate(self.processes):
+            for process_index, node in enumerate(processes):
+                node.API = self.router.api(node.LakeState.prefix(position),
+                                           thread_count,
+                                           process_index, process_count)
+        self.display = Display(self.processes)
+        self.router.sink(self.display.sink)
+
+    @staticmethod
+    def __load(position, process_index):
+        spec = importlib.util.spec_from_file_location(
+            'fish_position_%d_%d' % (position, process_index), Lake.path
+        )
+        node = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(node)
+        return node
+
+    @staticmethod
+    def __setup(node, settings):
+        # settings is a dict of 'Class.attribute' -> value
+        if settings is None:
+            return
+        for name, value in settings.items():
+            (class_name, attribute) = name.split('.')
+            setattr(getattr(node, class_name), attribute, value)
+
+    def start(self):
+        for processes in self.processes:
+            for node in processes:
+                for thread_index in range(node.API.thread_count()):
+                    task = node.Task(thread_index)
+                    task.daemon = True
+                    task.start()
+                    self.__threads.append(task)
+        # wait for the node positions to be set
+        while any(node.LakeState.position is None
+                  for processes in self.processes for node in processes):
+            threading.Event().wait(0.01)
+
+    def stop(self):
+        self.router.stop()
+        for task in self.__threads:
+            task.join()
+        for processes in self.processes:
+            for node in reversed(processes):
+                node.FrameBuffer.close()
+                node.Trace.flush()
+                node.Log.flush()
+
+    def populate(self, count, lifespan):
+        # add count fish to each node position, with lifespan seconds
+        for position, node in enumerate(self.nodes):
+            prefix = node.LakeState.prefix(position)
+            for _ in range(count):
+                self.router.send(prefix, prefix + 'lake', b'',
+                                 node.FishState().encode(),
+                                 int(lifespan * 1000), 0,
+                                 uuid.uuid1().bytes)
+
+    def stats(self):
+        # JSON stats snapshot of each node position
+        # (combining the snapshots of each process)
+        return [Lake.__stats_combine([
+            json.loads(node.Stats.snapshot().decode('utf-8'))
+            for node in processes
+        ], processes[0].Stats.gauges_max) for processes in self.processes]
+
+    @staticmethod
+    def __stats_combine(snapshots, gauges_max):
+        combined = snapshots[0]
+        for snapshot in snapshots[1:]:
+            for key in ('counters', 'rates', 'gauges'):
+                for name, value in snapshot[key].items():
+                    if key == 'gauges' and name in gauges_max:
+                        combined[key][name] = max(combined[key].get(name, 0),
+                                                  value)
+                    else:
+                        combined[key][name] = (combined[key].get(name, 0) +
+                                               value)
+            for name, histogram in snapshot['histograms'].items():
+                histogram_combined = combined['histograms'].get(name)
+                if histogram_combined is None:
+                    combined['histograms'][name] = histogram
+                    continue
+                count = histogram_combined['count'] + histogram['count']
+                if count > 0:
+                    histogram_combined['mean_ms'] = (
+                        histogram_combined['count'] *
+                        histogram_combined['mean_ms'] +
+                        histogram['count'] * histogram['mean_ms']
+                    ) / count
+                histogram_combined['count'] = count
+                buckets = histogram_combined['buckets']
+                for bucket, bucket_count in histogram['buckets'].items():
+                    buckets[bucket] = buckets.get(bucket, 0) + bucket_count
+        return combined
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate the fish.py lake without CloudI',
+    )
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help='seconds')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='CloudI count_thread of each node')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='CloudI count_process of each node')
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help='milliseconds between node positions')
+    parser.add_argument('--fish', type=int, default=0,
+                        help='fish added to each node position at start')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='Class.attribute=value',
+                        help='fish.py class attribute setting')
+    parser.add_argument('--check-frames', action='store_true',
+                        help='check the FrameEncoding round-trip and exit')
+    args = parser.parse_args()
+    settings = {'Log.level': 'warn'}
+    for setting in args.set:
+        (name, value) = setting.split('=', 1)
+        settings[name] = json.loads(value)
+    lake = Lake(thread_count=args.threads, latency_remote=args.latency,
+                settings=settings, process_count=args.processes)
+    if args.check_frames:
+        Display.check(lake.nodes[0])
+        print('FrameEncoding round-trip check passed')
+        return
+    lake.start()
+    lake.populate(args.fish, args.duration + 60.0)
+    threading.Event().wait(args.duration)
+    stats = lake.stats()
+    lake.stop()
+    print(json.dumps({
+        'router': lake.router.counters,
+        'display': dict(lake.display.counters, rows=[
+            lake.display.rows(position)
+            for position in range(len(lake.nodes))
+        ]),
+        'positions': stats,
+    }, indent=4, sort_keys=True))
+
+if __name__ == '__main__':
+    main()